@@ -12,45 +12,14 @@ from multiprocessing import Pool, RLock
 import ctypes as ct
 import numpy as np
 
+from hmm_kernels import forward_scaled, backward_scaled, emission_matrix
+
 def forward_with_t_scaled(a,pi,y,N,T,d, t_table): #N is the number of states and d is the target sentence
     # y is the source sentence
     # d is the dest sentence
-    c_scaled = ones(T+1)
-    alpha_hat = zeros((N+1,T+1))
-    total_alpha_double_dot = 0
-    for i in range(1,N+1):
-        alpha_hat[(i,1)] = pi[i]*t_table[(y[0],d[i-1])]
-        total_alpha_double_dot += alpha_hat[(i,1)]
-    c_scaled[1] = 1.0/total_alpha_double_dot
-    #alpha_hat[:,1] = c_scaled[1]*alpha_hat[:,1]
-    for i in range(1,N+1):
-        alpha_hat[(i,1)] = c_scaled[1]*alpha_hat[(i,1)]
-    for t in range(1,T):
-        total_alpha_double_dot = 0
-        for j in range(1,N+1):
-            total = 0
-            for i in range(1,N+1):
-                total += alpha_hat[(i,t)]*a[(i,j,N)]
-            alpha_hat[(j,t+1)] = t_table[(y[t],d[j-1])]*total
-            total_alpha_double_dot += alpha_hat[(j,t+1)]
-        c_scaled[t+1] = 1.0/total_alpha_double_dot
-        for i in range(1,N+1):
-            alpha_hat[(i,t+1)] = c_scaled[t+1]*alpha_hat[(i,t+1)]
-        #alpha_hat[:,t+1] = c_scaled[t+1]*alpha_hat[:,t+1]
-
-    return (alpha_hat,c_scaled)
+    return forward_scaled(np.array([[a[(i,j,N)] for j in range(1,N+1)] for i in range(1,N+1)]).reshape((N,N)), pi[1:N+1], emission_matrix(t_table, y[:T], d[:N]))
 def backward_with_t_scaled(a,pi,y,N,T,d, t_table,c_scaled):
-    beta_hat = zeros((N+1,T+1))
-    for i in range(1,N+1):
-        beta_hat[(i,T)] = c_scaled[T]
-    #beta_hat[:,T] = c_scaled[T]
-    for t in range(T-1,0,-1):
-        for i in range(1,N+1):
-            total = 0
-            for j in range(1,N+1):
-                total += beta_hat[(j,t+1)]*a[(i,j,N)]*t_table[(y[t],d[j-1])]
-            beta_hat[(i,t)] = c_scaled[t]*total
-    return beta_hat
+    return backward_scaled(np.array([[a[(i,j,N)] for j in range(1,N+1)] for i in range(1,N+1)]).reshape((N,N)), emission_matrix(t_table, y[:T], d[:N]), c_scaled)
 
 
 def initializeUniformly(N): # K is the number of all possible values for Ys
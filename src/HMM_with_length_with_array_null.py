@@ -8,54 +8,36 @@ from collections import defaultdict
 from numpy import zeros, ones, log
 import sys
 import time
-from multiprocessing import Process, Value, Array, Manager
-from multiprocessing import Pool, RLock
+from multiprocessing import Process, Array, Manager, Event
+from multiprocessing import Pool
 import ctypes as ct
 import numpy as np
 
+from hmm_kernels import forward_scaled, backward_scaled, emission_matrix, forward_scaled_batch, backward_scaled_batch
+from hmm_kernels import expected_transitions, diagonal_jump_counts, jump_buckets
+from hmm_kernels import fold_jumps, band_structure, banded_jump_counts, log_band, banded_max_plus
+from hmm_kernels import forward_scaled_banded, backward_scaled_banded, forward_scaled_banded_batch, backward_scaled_banded_batch
+from hmm_kernels import forward_scaled_pruned, backward_scaled_pruned
+from corpus import length_buckets
+from em_schedule import EMSchedule, HELDOUT_FLOOR
+
 p0H = 0.2
 null_emission_prob = 0.1
 smooth_factor = 0.1
+# Largest B*T*N of one batch of equal-length sentences in the batched E step
+MAX_BATCH_CELLS = 1 << 20
+# Sentences on which the log-likelihood lost by a pruned E step is measured
+PRUNE_CHECK_SENTENCES = 100
+# Shortest target length for which forward-backward runs on the band of a jump window;
+# below it the dense matrix products are faster and give the same result
+BANDED_MIN_STATES = 200
 
 def forward_with_t_scaled(a,pi,y,N,T,d, t_table): #N is the number of states and d is the target sentence
     # y is the source sentence
     # d is the dest sentence
-    c_scaled = ones(T+1)
-    alpha_hat = zeros((N+1,T+1))
-    total_alpha_double_dot = 0
-    for i in range(1,N+1):
-        alpha_hat[(i,1)] = pi[i]*t_table[(y[0],d[i-1])]
-        total_alpha_double_dot += alpha_hat[(i,1)]
-    c_scaled[1] = 1.0/total_alpha_double_dot
-    #alpha_hat[:,1] = c_scaled[1]*alpha_hat[:,1]
-    for i in range(1,N+1):
-        alpha_hat[(i,1)] = c_scaled[1]*alpha_hat[(i,1)]
-    for t in range(1,T):
-        total_alpha_double_dot = 0
-        for j in range(1,N+1):
-            total = 0
-            for i in range(1,N+1):
-                total += alpha_hat[(i,t)]*a[(i,j,N)]
-            alpha_hat[(j,t+1)] = t_table[(y[t],d[j-1])]*total
-            total_alpha_double_dot += alpha_hat[(j,t+1)]
-        c_scaled[t+1] = 1.0/total_alpha_double_dot
-        for i in range(1,N+1):
-            alpha_hat[(i,t+1)] = c_scaled[t+1]*alpha_hat[(i,t+1)]
-        #alpha_hat[:,t+1] = c_scaled[t+1]*alpha_hat[:,t+1]
-
-    return (alpha_hat,c_scaled)
+    return forward_scaled(a[1:N+1,1:N+1,N], pi[1:N+1], emission_matrix(t_table, y[:T], d[:N]))
 def backward_with_t_scaled(a,pi,y,N,T,d, t_table,c_scaled):
-    beta_hat = zeros((N+1,T+1))
-    for i in range(1,N+1):
-        beta_hat[(i,T)] = c_scaled[T]
-    #beta_hat[:,T] = c_scaled[T]
-    for t in range(T-1,0,-1):
-        for i in range(1,N+1):
-            total = 0
-            for j in range(1,N+1):
-                total += beta_hat[(j,t+1)]*a[(i,j,N)]*t_table[(y[t],d[j-1])]
-            beta_hat[(i,t)] = c_scaled[t]*total
-    return beta_hat
+    return backward_scaled(a[1:N+1,1:N+1,N], emission_matrix(t_table, y[:T], d[:N]), c_scaled)
 
 
 def initializeUniformly(N): # K is the number of all possible values for Ys
@@ -98,6 +80,38 @@ def initializeBasedOnC(N):
 #             b[(j,y_t)] = t[(y_t,)]
     return (a,pi)
 
+def initializeBasedOnJumps(N, c, window=None):
+    # Starting point for the null HMM from a jump prior c[d] (e.g. the one of EM_IBM2_diagonal):
+    # p(j|i) proportional to c[j-i], with the null states and smoothing of the M step. With a
+    # jump window, the prior is folded into its tail buckets like the E step counts.
+    if window is not None:
+        c = fold_jumps(c, window)
+    twoN = 2*N
+    a = zeros((twoN+1,twoN+1,N+1))
+    pi = zeros(twoN+1)
+    for i in range(1,twoN+1):
+        pi[i] = 1.0/twoN
+    transition_probabilities(a, N, np.array([c[d] for d in range(1-N,N)], dtype=np.float64), window)
+    return (a,pi)
+
+def jump_histogram_slice(N):
+    # The jump histograms of all target lengths are kept in one flat array: the 2N-1 entries
+    # c[d+N-1], d = 1-N..N-1, of target length N are at (N-1)^2..N^2-1
+    return slice((N-1)*(N-1), N*N)
+
+def transition_probabilities(a, I, c, window=None):
+    # a[.,.,I] from the jump histogram c of target length I: p(j|i) proportional to
+    # c[bucket(j-i)] (uniform for a state without any jump), the null states and smoothing
+    jumps = c[jump_buckets(I, window)]
+    total = jumps.sum(axis=1)
+    jumps[total == 0] = 1.0
+    a[1:I+1,1:I+1,I] = (1-p0H)*jumps/jumps.sum(axis=1)[:,None]
+    a[I+1:2*I+1,1:I+1,I] = a[1:I+1,1:I+1,I]
+    states = np.arange(1,I+1)
+    a[states,states+I,I] = p0H
+    a[states+I,states+I,I] = p0H
+    smooth_transition_probabilities(a, I)
+
 def maxTargetSentenceLength(bitext):
     maxLength = 0
     target_length_map = dict()
@@ -111,9 +125,7 @@ def maxTargetSentenceLength(bitext):
 #   Smoothing transition probabilities, Och and Ney, 2000
 #   (Here, we use smoothing equation but for the whole english sentence with length 2I to get right probabilities)
 def smooth_transition_probabilities(a, I):
-    for i in range(1, 2*I+1):
-        for j in range(1,2*I+1):
-            a[i][j][I] = smooth_factor*(0.5/I) + (1 - smooth_factor) * a[i][j][I]
+    a[1:2*I+1,1:2*I+1,I] = smooth_factor*(0.5/I) + (1 - smooth_factor) * a[1:2*I+1,1:2*I+1,I]
 
 
 def map_bitext_to_int(sd_count):
@@ -125,7 +137,114 @@ def map_bitext_to_int(sd_count):
         biword[i] = (s,d)
     return (index,biword)
 
-def baumWelch(bitext_sd, s_count,t_table,sd_count):#L is the number of observations
+def event_probabilities(t_table, sd_count):
+    # t of every event of sd_count, in event id order (the order of map_bitext_to_int)
+    if hasattr(t_table, 'lookup'):
+        return t_table.lookup(sd_count.event_sources(), sd_count.event_targets())
+    return np.array([t_table[(s,d)] for (s,d) in sd_count], dtype=np.float64)
+
+def length_batches(bitext, intervals):
+    # The length buckets of bitext cut into batches of at most MAX_BATCH_CELLS cells and
+    # dealt to intervals workers, largest first, so that every worker gets a similar load
+    batches = []
+    for (N, T, indices) in length_buckets(bitext):
+        if N == 0 or T == 0:
+            continue
+        size = max(1, MAX_BATCH_CELLS/(N*T))
+        for start in range(0, len(indices), size):
+            batches.append((N, T, indices[start:start+size]))
+    batches.sort(key=lambda (N, T, indices): -N*T*len(indices))
+    return [batches[k::intervals] for k in range(intervals)]
+
+def statistics_size(N, sd_size):
+    return 1 + (N+1) + sd_size + (N+1) + N*N
+
+def split_statistics(statistics, N, sd_size):
+    # The E step totals as views into one flat buffer of statistics_size(N, sd_size): the
+    # log-likelihood, gamma[i], gamma summed over the states for every event, gamma at t=1
+    # and the jump histograms of every target length (see jump_histogram_slice)
+    bounds = np.cumsum([0, 1, N+1, sd_size, N+1, N*N])
+    return [statistics[bounds[k]:bounds[k+1]] for k in range(len(bounds) - 1)]
+
+def reduce_statistics(statistics, k, done):
+    # Rows of statistics are summed in a binary tree by the workers themselves: in the round
+    # of step s, worker k (a multiple of 2s) adds row k+s once worker k+s has set done[k+s].
+    # Row 0 ends up with the totals.
+    step = 1
+    while k % (2*step) == 0 and k + step < len(statistics):
+        done[k+step].wait()
+        statistics[k] += statistics[k+step]
+        step *= 2
+    done[k].set()
+
+def expectation_worker(expectation, statistics, k, done, args):
+    # Worker k of the E step: expectation accumulates its share of the corpus into a private
+    # buffer, published once into row k of the shared statistics, then reduced. No lock is
+    # taken. A worker that fails never sets done[k], see join_workers.
+    private = np.zeros(statistics.shape[1])
+    expectation(private, *args)
+    statistics[k] = private
+    reduce_statistics(statistics, k, done)
+
+def join_workers(jobs):
+    # Waits for the E step workers. When one fails, the workers waiting for its row are
+    # stopped and the iteration fails instead of running the M step on partial statistics.
+    running = list(jobs)
+    while running:
+        running[0].join(0.1)
+        failed = [p for p in jobs if p.exitcode not in (None, 0)]
+        if failed:
+            for p in jobs:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+            raise RuntimeError("E step worker %s exited with code %d" % (failed[0].name, failed[0].exitcode))
+        running = [p for p in running if p.is_alive()]
+
+def Expectation_batched(statistics, t_events, sd_count, Y, batches, sd_size, N_max, iterations, a, pi, jump_prior=None, window=None):
+    # Expectation2 over batches of sentences with the same (N, T): they share the transition
+    # matrix, so forward, backward, the posteriors and the jump counts c[d] are numpy
+    # operations on B x T x N arrays. Counts are summed over the batch and added to the
+    # statistics (see split_statistics) at once.
+    (logLikelihood, gamma_totals, gamma_delta_totals, gamma1_totals, jump_histograms) = split_statistics(statistics, N_max, sd_size)
+    for (N, T, indices) in batches:
+        if iterations == 0:
+            if jump_prior is not None:
+                (a, pi) = initializeBasedOnJumps(N, jump_prior, window)
+            else:
+                (a, pi) = initializeUniformly(N)
+        A = a[1:N+1,1:N+1,N]
+        (S, D) = Y.stack(indices)
+        pairs = sd_count.pair_ids(S[:,:,None], D[:,None,:])
+        emission = t_events[pairs]
+        if window is not None and N >= BANDED_MIN_STATES:
+            band = band_structure(A, window)
+            (alpha_hat, c_scaled) = forward_scaled_banded_batch(band, np.asarray(pi[1:N+1]), emission)
+            beta_hat = backward_scaled_banded_batch(band, emission, c_scaled)
+        else:
+            (alpha_hat, c_scaled) = forward_scaled_batch(A, np.asarray(pi[1:N+1]), emission)
+            beta_hat = backward_scaled_batch(A, emission, c_scaled)
+        gamma = alpha_hat[:,1:,1:]*beta_hat[:,1:,1:]/c_scaled[:,None,1:]
+
+        #gamma(i,t) summed for the event of (y_t, x_i)
+        (events, position) = np.unique(pairs.transpose((0,2,1)), return_inverse=True)
+        gamma_delta = np.bincount(position, weights=gamma.ravel())
+
+        #xi summed over the batch and over t, then c[d] as the sums of its diagonals j-i=d
+        if window is not None and N >= BANDED_MIN_STATES:
+            c = banded_jump_counts(alpha_hat, beta_hat, emission, band)
+        else:
+            c = diagonal_jump_counts(expected_transitions(alpha_hat, beta_hat, emission, A), window)
+
+        logLikelihood[0] += -np.log(c_scaled[:,1:]).sum()
+        gamma_totals[1:N+1] += gamma.sum(axis=(0,2))
+        gamma_delta_totals[events] += gamma_delta
+        gamma1_totals[1:N+1] += gamma[:,:,0].sum(axis=0)
+        jump_histograms[jump_histogram_slice(N)] += c
+
+def baumWelch(bitext_sd, s_count,t_table,sd_count,schedule=None,jump_prior=None,window=None,prune=None):#L is the number of observations
+    if schedule is None:
+        schedule = EMSchedule('HMM')
 
     (N, target_length_map) = maxTargetSentenceLength(bitext_sd)
     print 'N',N
@@ -139,8 +258,10 @@ def baumWelch(bitext_sd, s_count,t_table,sd_count):#L is the number of observati
     #target length list is used for filtering out the re-estimation computation for the lengths that do not exist in the training data
 
     L = len(Y)
+    #The parameters of the iteration with the best held-out perplexity (see EMSchedule)
+    best = None
 
-    for iterations in range(0,10):
+    for iterations in schedule:
         #E step
         #c = defaultdict(int)
         startTime = time.time()
@@ -152,17 +273,31 @@ def baumWelch(bitext_sd, s_count,t_table,sd_count):#L is the number of observati
         totalGammaDeltaOverAllObservations_t_overall_states_over_dest = defaultdict(int)
 
         totalGamma1OverAllObservations = zeros(N+1)
-        totalC_j_Minus_iOverAllObservations = zeros((N+1,N+1,N+1))
-        totalC_l_Minus_iOverAllObservations = zeros((N+1,N+1))
+        totalJumpHistogramsOverAllObservations = zeros(N*N)
         for (y,x) in Y: #y is the source sentence and x is the target sentence
             T = len(y)
             N = len(x)
-            c = defaultdict(int)
 
             if iterations == 0:
-                (a, pi) = initializeUniformly(N)
-            alpha_hat, c_scaled = forward_with_t_scaled(a, pi, y, N, T, x, t_table) #BE careful on indexing on x
-            beta_hat = backward_with_t_scaled(a, pi, y, N, T, x, t_table, c_scaled) #else:
+                if jump_prior is not None:
+                    (a, pi) = initializeBasedOnJumps(N, jump_prior, window)
+                else:
+                    (a, pi) = initializeUniformly(N)
+            #t(y_t|x_j) of the sentence, read once for the forward, backward and xi passes
+            emission = emission_matrix(t_table, y, x)
+            #states[t]: the states 1..N visited at word t, all of them unless pruned
+            states = [range(1,N+1)]*(T+1)
+            if prune is not None:
+                alpha_hat, c_scaled, kept = forward_scaled_pruned(a[1:N+1,1:N+1,N], pi[1:N+1], emission, prune)
+                beta_hat = backward_scaled_pruned(a[1:N+1,1:N+1,N], emission, c_scaled, kept)
+                states = [None] + [(np.flatnonzero(kept[t]) + 1).tolist() for t in range(T)]
+            elif window is not None and N >= BANDED_MIN_STATES:
+                band = band_structure(a[1:N+1,1:N+1,N], window)
+                alpha_hat, c_scaled = forward_scaled_banded(band, pi[1:N+1], emission)
+                beta_hat = backward_scaled_banded(band, emission, c_scaled)
+            else:
+                alpha_hat, c_scaled = forward_scaled(a[1:N+1,1:N+1,N], pi[1:N+1], emission) #BE careful on indexing on x
+                beta_hat = backward_scaled(a[1:N+1,1:N+1,N], emission, c_scaled) #else:
 
             #alpha_hat = forward_with_t(a, pi, y, N, T, x, t_table)
             #beta_hat = backward_with_t(a, pi, y, N, T, x, t_table)
@@ -170,13 +305,12 @@ def baumWelch(bitext_sd, s_count,t_table,sd_count):#L is the number of observati
 	    #print beta_hat
 	    #print c_scaled
             gamma = zeros((N+1,T+1))
-            xi = zeros((N+1,N+1,T+1))
             #gamma = (alpha_hat*beta_hat)/c_scaled
             #liklihood = 1.0/np.prod(c_scaled)
             for t in range(1,T):
                 logLikelihood += -log(c_scaled[t])
 
-                for i in range(1,N+1):
+                for i in states[t]:
                     gamma[(i,t)] = (alpha_hat[(i,t)]*beta_hat[(i,t)])/c_scaled[t]
                     totalGammaOverAllObservations[i] += gamma[(i,t)]
                     totalGammaDeltaOverAllObservations_t[(i,indexMap[(y[t-1],x[i-1])])] += gamma[(i,t)]
@@ -184,53 +318,26 @@ def baumWelch(bitext_sd, s_count,t_table,sd_count):#L is the number of observati
             t = T
             logLikelihood += -log(c_scaled[t])
             #print 'likelihood ', liklihood, logLikelihood
-            for i in range(1,N+1):
+            for i in states[t]:
                 gamma[(i,t)] = (alpha_hat[(i,t)]*beta_hat[(i,t)])/c_scaled[t]
                 totalGammaOverAllObservations[i] += gamma[(i,t)]
                 totalGammaDeltaOverAllObservations_t[(i,indexMap[(y[t-1],x[i-1])])] += gamma[(i,t)]
 	    #print totalGammaOverAllObservations
-            for t in range(1,T):
-                for i in range(1,N+1):
-                    for j in range(1,N+1):
-                        xi[(i,j,t)] = (alpha_hat[(i,t)]*a[(i,j,N)]*t_table[(y[t],x[j-1])]*beta_hat[(j,t+1)])
-
             for i in range(1,N+1):
                 totalGamma1OverAllObservations[i] += gamma[(i,1)]
-            for d in range(-N - 1,N+1):
-                #c[d] = 0
-                for t in range(1,T):
-                    for i in range(1,N+1):
-                        if i+d <= N and i+d >= 1:
-                            c[d] += xi[(i,i+d,t)]
-
-            #Liang et al. suggestion
-#             for d in c:
-#                 if d < -7:
-#                     c[-7] += c[d]
-#                     c[d] = 0
-#                 if d > 7:
-#                     c[7] += c[d]
-#                     c[d] = 0
 
+            #xi summed over t, then c[d] as the sums of its diagonals j-i=d; Liang et al.
+            #suggestion: with a jump window, jumps longer than the window share the tail
+            #bucket of their side (see jump_bucket)
+            if prune is None and window is not None and N >= BANDED_MIN_STATES:
+                c = banded_jump_counts(alpha_hat[None], beta_hat[None], emission[None], band)
+            else:
+                c = diagonal_jump_counts(expected_transitions(alpha_hat[None], beta_hat[None], emission[None], a[1:N+1,1:N+1,N]), window)
+            totalJumpHistogramsOverAllObservations[jump_histogram_slice(N)] += c
 
-            for i in range(1,N+1):
-                for j in range(1,N+1):
-#                     if j-i >= 7:
-#                         totalC_j_Minus_iOverAllObservations[(i,j)] += c[7]
-#                     elif j-i <= -7:
-#                         totalC_j_Minus_iOverAllObservations[(i,j)] += c[-7]
-#                     else:
-                        totalC_j_Minus_iOverAllObservations[(i,j,N)] += c[j-i]
-                for l in range(1,N+1):
-#                     if l-i >= 7:
-#                         totalC_l_Minus_iOverAllObservations[i] += c[7]
-#                     elif l-i <= -7:
-#                         totalC_l_Minus_iOverAllObservations[i] += c[-7]
-#                     else:
-                        totalC_l_Minus_iOverAllObservations[(i, N)] += c[l-i]
-
-	    #print totalC_j_Minus_iOverAllObservations
         print 'likelihood ', logLikelihood
+        if prune is not None:
+            print 'log-likelihood lost by pruning on %d sentences: %f' % pruning_error(a, pi, t_table, Y[:PRUNE_CHECK_SENTENCES], prune, iterations == 0, jump_prior, window)
         #lastLikelihood = liklihood
         N = len(totalGamma1OverAllObservations)-1
         #print N
@@ -248,6 +355,7 @@ def baumWelch(bitext_sd, s_count,t_table,sd_count):#L is the number of observati
         a = zeros((2*N+1,2*N+1,N+1))
         #a = dict()
         pi = zeros(2*N+1)
+        last_t_table = t_table
         t_table = defaultdict(int)
 
         #print 'pi', pi
@@ -255,138 +363,112 @@ def baumWelch(bitext_sd, s_count,t_table,sd_count):#L is the number of observati
         for i in range(1,2*N+1):
             pi[i] = 1.0/twoN #totalGamma1OverAllObservations[i]*(1.0/L)
 
-            '''for j in range(1,N+1):
-                a[(i,j)] = totalC_j_Minus_iOverAllObservations[(i,j)]/totalC_l_Minus_iOverAllObservations[i]
-            '''
-        #a[(i,j,I)] = p(j|i,I)
-        #for (i, j, I) in totalC_j_Minus_iOverAllObservations:
-        for I in target_length_map:
-            for i in range(1,I+1):
-                for j in range(1,I+1):
-                    a[(i,j,I)] = (1-p0H)*totalC_j_Minus_iOverAllObservations[(i,j,I)]/totalC_l_Minus_iOverAllObservations[i,I]
-
-        for I in target_length_map:
-            for i in range(1,I+1):
-                for j in range(1,I+1):
-                    a[i][i + I][I] = p0H
-                    a[i + I][i + I][I] = p0H
-
+        #a[(i,j,I)] = p(j|i,I), from the jump histogram of target length I
         for I in target_length_map:
-            for i in range(1,N+1):
-                for j in range(1,N+1):
-                    a[i+I][j][I] = a[i][j][I]
-
-         #************RUN IT ON TWON
-        #normalize_table(a)
-        for I in target_length_map:
-            smooth_transition_probabilities(a, I)
+            if I > 0:
+                transition_probabilities(a, I, totalJumpHistogramsOverAllObservations[jump_histogram_slice(I)], window)
 
         '''for I in target_length_map:
             check_probability(a, I)
         '''
         for k in range(sd_size):
             (f,e) = biword[k]
-            t_table[(f,e)] = totalGammaDeltaOverAllObservations_t_overall_states[k]/totalGammaDeltaOverAllObservations_t_overall_states_over_dest[e]
+            if totalGammaDeltaOverAllObservations_t_overall_states_over_dest[e] > 0:
+                t_table[(f,e)] = totalGammaDeltaOverAllObservations_t_overall_states[k]/totalGammaDeltaOverAllObservations_t_overall_states_over_dest[e]
+            else:
+                #Every state of e was pruned away: e keeps its last probabilities
+                t_table[(f,e)] = last_t_table[(f,e)]
         endTime = time.time()
         print "run time for one iteration of hmm_with_length_with_array model %.2gs" % (endTime - startTime)
         print iterations
+        if schedule.heldout is not None:
+            schedule.end_iteration(logLikelihood, *heldout_log_likelihood(a, pi, t_table, schedule.heldout, window))
+            if schedule.improved():
+                best = (a,t_table,pi)
+        else:
+            schedule.end_iteration(logLikelihood)
     print target_length_map
+    if best is not None:
+        return best
     return (a,t_table,pi)
 
 
-def Expectation2(lock, t_table, N, Y, sd_size, indexMap, iterations, totalGammaOverAllObservations, totalGammaDeltaOverAllObservations_t, totalGamma1OverAllObservations, totalC_j_Minus_iOverAllObservations, totalC_l_Minus_iOverAllObservations,start,end,a, pi,logLikelihood, lastLogLikelihood):
+def Expectation2(statistics, t_table, N, Y, sd_size, indexMap, iterations,start,end,a, pi, jump_prior=None, window=None, prune=None):
     #print 'Expectation2'
+    (logLikelihood, totalGammaOverAllObservations, totalGammaDeltaOverAllObservations_t, totalGamma1OverAllObservations, totalJumpHistogramsOverAllObservations) = split_statistics(statistics, N, sd_size)
     for y, x in Y[start:end]: #y is the source sentence and x is the target sentence
         T = len(y)
         N = len(x)
-        c = defaultdict(int)
         #print 'it', iterations
         if iterations == 0:
-            (a, pi) = initializeUniformly(N)
-        alpha_hat, c_scaled = forward_with_t_scaled(a, pi, y, N, T, x, t_table) #BE careful on indexing on x
-        beta_hat = backward_with_t_scaled(a, pi, y, N, T, x, t_table, c_scaled) #else:
+            if jump_prior is not None:
+                (a, pi) = initializeBasedOnJumps(N, jump_prior, window)
+            else:
+                (a, pi) = initializeUniformly(N)
+        #t(y_t|x_j) of the sentence, read once for the forward, backward and xi passes
+        emission = emission_matrix(t_table, y, x)
+        #states[t]: the states 1..N visited at word t, all of them unless pruned
+        states = [range(1, N + 1)]*(T + 1)
+        if prune is not None:
+            alpha_hat, c_scaled, kept = forward_scaled_pruned(a[1:N+1,1:N+1,N], pi[1:N+1], emission, prune)
+            beta_hat = backward_scaled_pruned(a[1:N+1,1:N+1,N], emission, c_scaled, kept)
+            states = [None] + [(np.flatnonzero(kept[t]) + 1).tolist() for t in range(T)]
+        elif window is not None and N >= BANDED_MIN_STATES:
+            band = band_structure(a[1:N+1,1:N+1,N], window)
+            alpha_hat, c_scaled = forward_scaled_banded(band, pi[1:N+1], emission)
+            beta_hat = backward_scaled_banded(band, emission, c_scaled)
+        else:
+            alpha_hat, c_scaled = forward_scaled(a[1:N+1,1:N+1,N], pi[1:N+1], emission) #BE careful on indexing on x
+            beta_hat = backward_scaled(a[1:N+1,1:N+1,N], emission, c_scaled) #else:
         #    alpha = forward(a, b, pi, y, N, T)
         #    beta = backward(a, b, pi, y, N, T)
         gamma = np.zeros((N + 1, T + 1))
-        xi = zeros((N + 1, N + 1, T + 1))
 
         for t in range(1, T):
             #print 'c_scaled ',c_scaled[t]
-            with lock:
-                logLikelihood.value += -(log(c_scaled[t]))
-            for i in range(1, N + 1):
+            logLikelihood[0] += -(log(c_scaled[t]))
+            for i in states[t]:
                 gamma[(i,t)] = (alpha_hat[(i,t)]*beta_hat[(i,t)])/c_scaled[t]
-                with lock:
-                    totalGammaOverAllObservations[i] += gamma[i, t]
-                address = (i * sd_size) + indexMap[(y[t - 1], x[i - 1])]
-                with lock:
-                    totalGammaDeltaOverAllObservations_t[address] += gamma[i, t]
+                totalGammaOverAllObservations[i] += gamma[i, t]
+                totalGammaDeltaOverAllObservations_t[indexMap[(y[t - 1], x[i - 1])]] += gamma[i, t]
         t = T
-        with lock:
-            logLikelihood.value += -(log(c_scaled[t]))
-        for i in range(1, N + 1): #
+        logLikelihood[0] += -(log(c_scaled[t]))
+        for i in states[t]: #
             gamma[(i,t)] = (alpha_hat[(i,t)]*beta_hat[(i,t)])/c_scaled[t]
-            with lock:
-                totalGammaOverAllObservations[i] += gamma[i, t] #               totalGammaDeltaOverAllObservations[(i,y[t-1])] += gamma[(i,t)]
+            totalGammaOverAllObservations[i] += gamma[i, t] #               totalGammaDeltaOverAllObservations[(i,y[t-1])] += gamma[(i,t)]
             #totalGammaDeltaOverAllObservations_t[(i,y[t-1],x[i-1])] += gamma[(i,t)]
-            address = (i * sd_size) + indexMap[(y[t - 1], x[i - 1])]
-            with lock:
-                totalGammaDeltaOverAllObservations_t[address] += gamma[i, t]
-        for t in range(1, T):
-            for i in range(1, N + 1):
-                for j in range(1, N + 1):
-#                        if iterations == 0:
-                    xi[i, j, t] = alpha_hat[(i, t)] * a[(i, j, N)] * t_table[(y[t], x[j - 1])] * beta_hat[(j, t + 1)] #                        else:
-
-#                            xi[(i,j,t)] = (alpha[(i,t)]*a[(i,j)]*b[(j,y[t])]*beta[(j,t+1)])/total[t]
-#                        totalXiOverAllObservations[(i,j)] += xi[(i,j,t)]
+            totalGammaDeltaOverAllObservations_t[indexMap[(y[t - 1], x[i - 1])]] += gamma[i, t]
         for i in range(1, N + 1):
 
             totalGamma1OverAllObservations[i] += gamma[i, 1]
 
-        for d in range(-N - 1, N+1):
-            #c[d] = 0
-            for t in range(1, T):
-                for i in range(1, N + 1):
-                    if i + d <= N and i + d >= 1:
-                        c[d] += xi[i, i + d, t]
-
-        #print 'c',c
-        #Liang et al. suggestion
-#             for d in c:
-#                 if d < -7:
-#                     c[-7] += c[d]
-#                     c[d] = 0
-#                 if d > 7:
-#                     c[7] += c[d]
-#                     c[d] = 0
-	#print 'totalC_j_Minus_iOverAllObservations',totalC_j_Minus_iOverAllObservations
-        #print 'N',N
-        for i in range(1, N + 1):
-                for j in range(1, N + 1): #                     if j-i >= 7:
-    #                         totalC_j_Minus_iOverAllObservations[(i,j)] += c[7]
-    #                     elif j-i <= -7:
-    #                         totalC_j_Minus_iOverAllObservations[(i,j)] += c[-7]
-    #                     else:
-
-
-                    with lock:
-                        totalC_j_Minus_iOverAllObservations[(i,j, N)] += c[j - i]
-
-                for l in range(1, N + 1): #                     if l-i >= 7:
-#                         totalC_l_Minus_iOverAllObservations[i] += c[7]
-#                     elif l-i <= -7:
-#                         totalC_l_Minus_iOverAllObservations[i] += c[-7]
-#                     else:
-                    with lock:
-                        totalC_l_Minus_iOverAllObservations[(i, N)] += c[l - i]
+        #xi(i,j,t) = alpha_hat[i,t]*a[i,j]*t(y_t+1|x_j)*beta_hat[j,t+1] summed over t, then
+        #c[d] as the sums of its diagonals j-i=d; Liang et al. suggestion: with a jump window,
+        #jumps longer than the window share the tail bucket of their side (see jump_bucket)
+        if prune is None and window is not None and N >= BANDED_MIN_STATES:
+            c = banded_jump_counts(alpha_hat[None], beta_hat[None], emission[None], band)
+        else:
+            c = diagonal_jump_counts(expected_transitions(alpha_hat[None], beta_hat[None], emission[None], a[1:N+1,1:N+1,N]), window)
+        totalJumpHistogramsOverAllObservations[jump_histogram_slice(N)] += c
 
 
 
     #return N, i, a, pi, j
 
 
-def baumWelchP(bitext_sd, s_count,t_table,sd_count):#L is the number of observations
+def baumWelchP(bitext_sd, s_count,t_table,sd_count,schedule=None,jump_prior=None,batched=True,window=None,prune=None):#L is the number of observations
+    # With batched and an interned Corpus, the E step runs on equal-length batches
+    # (Expectation_batched) instead of one sentence at a time (Expectation2).
+    # With a jump window W, jumps longer than W are pooled into one tail bucket per side and
+    # forward and backward run over the band |j-i| <= W, O(N*W) per word instead of O(N^2),
+    # for target lengths of at least BANDED_MIN_STATES.
+    # With prune, forward-backward drops the states whose emission or share of the forward
+    # mass is below prune (see forward_scaled_pruned), on the full transition matrix even with
+    # a jump window; the log-likelihood this loses against the exact forward pass is printed
+    # after every E step (pruning_error). Pruning needs batched=False: the batched E step does
+    # not prune, since skipping states in its dense products costs more than it saves.
+    if schedule is None:
+        schedule = EMSchedule('HMM')
 
     (N, target_length_map) = maxTargetSentenceLength(bitext_sd)
     print 'N',N
@@ -412,84 +494,56 @@ def baumWelchP(bitext_sd, s_count,t_table,sd_count):#L is the number of observat
     #pi = zeros(N+1)
     pi = Array('d', twoN+1)
 
-    logLikelihood = Value('d',0.0)
-
-    lastLogLikelihood = Value('d',0.0)
+    lastLogLikelihood = 0.0
 
     L = len(Y)
     #N = len(Y[0][1]) #first sentence x length
     #(a,pi) = initializeUniformly(N)
 
-    for iterations in range(0,10):
+    intervals = 10
+    batched = batched and hasattr(Y, 'stack')
+    if batched and prune is not None:
+        raise ValueError("prune requires the per-sentence E step (batched=False)")
+    if batched:
+        batches = length_batches(Y, intervals)
+        t_events = event_probabilities(t_table, sd_count)
+
+    #Every worker publishes its E step totals once into its own row (see expectation_worker)
+    statistics_array = Array(ct.c_double, intervals*statistics_size(N, sd_size), lock=False)
+    statistics = np.frombuffer(statistics_array).reshape((intervals, statistics_size(N, sd_size)))
+    #The parameters of the iteration with the best held-out perplexity (see EMSchedule)
+    best = None
+
+    for iterations in schedule:
         #E step
         #c = defaultdict(int)
         startTime = time.time()
         print 'iteration',iterations
-        logLikelihood.value = 0.0
-        #totalGammaOverAllObservations = zeros(N+1)
-        totalGammaOverAllObservations = Array('d', [0]*(N+1))
-
-        #totalGammaDeltaOverAllObservations_t = zeros((N+1,sd_size))
-        totalGammaDeltaOverAllObservations_t = Array('d',[0]*((N+1)*(sd_size)))
-
-        #totalGammaDeltaOverAllObservations_t_overall_states = zeros(sd_size)
-        totalGammaDeltaOverAllObservations_t_overall_states = Array('d',[0]*sd_size)
 
         totalGammaDeltaOverAllObservations_t_overall_states_over_dest = defaultdict(int)
 
-
-        #totalGamma1OverAllObservations = zeros(N+1)
-        totalGamma1OverAllObservations = Array('d',[0]*(N+1))
-
-        #totalC_j_Minus_iOverAllObservations = zeros((N+1,N+1))
-
-        totalC_j_Minus_iOverAllObservations_array = Array(ct.c_double,(N+1)*(N+1)*(N+1))
-        totalC_j_Minus_iOverAllObservations_array2 = np.frombuffer(totalC_j_Minus_iOverAllObservations_array.get_obj())
-        totalC_j_Minus_iOverAllObservations = totalC_j_Minus_iOverAllObservations_array2.reshape((N+1,N+1,N+1))
-        for i in range(N+1):
-            for j in range(N+1):
-                for k in range(N+1):
-                    totalC_j_Minus_iOverAllObservations[i,j,k] = 0.0
-        '''
-        manager = Manager()
-
-        totalC_j_Minus_iOverAllObservations = manager.dict()
-        '''
-        #totalC_l_Minus_iOverAllObservations = zeros(N+1)
-
-        '''
-        totalC_l_Minus_iOverAllObservations = Array('d',[0]*(N+1))
-        '''
-        totalC_l_Minus_iOverAllObservations_array = Array(ct.c_double,(N+1)*(N+1))
-        totalC_l_Minus_iOverAllObservations_array2 = np.frombuffer(totalC_l_Minus_iOverAllObservations_array.get_obj())
-        totalC_l_Minus_iOverAllObservations = totalC_l_Minus_iOverAllObservations_array2.reshape((N+1,N+1))
-        for i in range(N+1):
-            for j in range(N+1):
-                totalC_l_Minus_iOverAllObservations[(i,j)] = 0.0
-        '''
-        manager2 = Manager()
-        totalC_l_Minus_iOverAllObservations = manager2.dict()
-        '''
         intervals = 10
         jobs = []
-        lock = RLock()
+        done = [Event() for k in range(intervals)]
+        statistics.fill(0.0)
         length_of_interval = L/intervals
-        for i in range(0,intervals-1):
-            start = i*length_of_interval
-            end = (i+1)*length_of_interval
-            #print start
-            #print end
-            p = Process(target=Expectation2, args = (lock, t_table, N, Y, sd_size, indexMap, iterations, totalGammaOverAllObservations, totalGammaDeltaOverAllObservations_t, totalGamma1OverAllObservations, totalC_j_Minus_iOverAllObservations, totalC_l_Minus_iOverAllObservations,start,end,a, pi,logLikelihood, lastLogLikelihood))
-            p.start()
-            jobs.append(p)
-
-        start = (intervals-1)*length_of_interval
-        end = L
-        p = Process(target=Expectation2, args = (lock, t_table, N, Y, sd_size, indexMap, iterations, totalGammaOverAllObservations, totalGammaDeltaOverAllObservations_t, totalGamma1OverAllObservations, totalC_j_Minus_iOverAllObservations, totalC_l_Minus_iOverAllObservations,start,end,a, pi,logLikelihood, lastLogLikelihood))
-        p.start()
-        jobs.append(p)
-        for p in jobs:
-            p.join()
+        if batched:
+            for k in range(intervals):
+                p = Process(target=expectation_worker, args = (Expectation_batched, statistics, k, done, (t_events, sd_count, Y, batches[k], sd_size, N, iterations, a, pi, jump_prior, window)))
+                p.start()
+                jobs.append(p)
+        else:
+            for k in range(0,intervals):
+                start = k*length_of_interval
+                end = (k+1)*length_of_interval if k < intervals-1 else L
+                #print start
+                #print end
+                p = Process(target=expectation_worker, args = (Expectation2, statistics, k, done, (t_table, N, Y, sd_size, indexMap, iterations,start,end,a, pi, jump_prior, window, prune)))
+                p.start()
+                jobs.append(p)
+        join_workers(jobs)
+        (logLikelihood, totalGammaOverAllObservations, totalGammaDeltaOverAllObservations_t_overall_states, totalGamma1OverAllObservations, totalJumpHistogramsOverAllObservations) = split_statistics(statistics[0], N, sd_size)
+        logLikelihood = logLikelihood[0]
 
 
         endTime = time.time()
@@ -498,9 +552,11 @@ def baumWelchP(bitext_sd, s_count,t_table,sd_count):#L is the number of observat
         print "%.2gs" % (endTime - startTime)
         #N = len(totalGamma1OverAllObservations)-1
         #print N
-        print 'last , new ', lastLogLikelihood.value, logLikelihood.value
-        #print 'likelihood difference ', (logLikelihood.value - lastLogLikelihood.value)
-        lastLogLikelihood.value = logLikelihood.value
+        print 'last , new ', lastLogLikelihood, logLikelihood
+        #print 'likelihood difference ', (logLikelihood - lastLogLikelihood)
+        lastLogLikelihood = logLikelihood
+        if prune is not None:
+            print 'log-likelihood lost by pruning on %d sentences: %f' % pruning_error(a, pi, t_table, Y[:PRUNE_CHECK_SENTENCES], prune, iterations == 0, jump_prior, window)
 
         totalGammaOverAllObservationsOverAllStates = 0.0
         sartTime = time.time()
@@ -519,13 +575,9 @@ def baumWelchP(bitext_sd, s_count,t_table,sd_count):#L is the number of observat
         # To make it more memory efficient just keep either totalGammaDeltaOverAllObservations_t_overall_states or expected_counts
         expected_counts = defaultdict(int)
 
-        for i in range(1,N+1):
-            for k in range(sd_size):
-
-                address = i*sd_size + k
-                totalGammaDeltaOverAllObservations_t_overall_states[k] += totalGammaDeltaOverAllObservations_t[address]
-                (f,e) = biword[k]
-                totalGammaDeltaOverAllObservations_t_overall_states_over_dest[e] += totalGammaDeltaOverAllObservations_t[address]
+        for k in range(sd_size):
+            (f,e) = biword[k]
+            totalGammaDeltaOverAllObservations_t_overall_states_over_dest[e] += totalGammaDeltaOverAllObservations_t_overall_states[k]
 
 
         for k in range(sd_size):
@@ -541,6 +593,7 @@ def baumWelchP(bitext_sd, s_count,t_table,sd_count):#L is the number of observat
         a = zeros((2*N+1,2*N+1,N+1))
 
         pi = zeros(2*N+1)
+        last_t_table = t_table
         t_table = defaultdict(int)
 
         #print 'pi', pi
@@ -548,31 +601,10 @@ def baumWelchP(bitext_sd, s_count,t_table,sd_count):#L is the number of observat
         for i in range(1,2*N+1):
             pi[i] = 1.0/twoN #totalGamma1OverAllObservations[i]*(1.0/L)
 
-            '''for j in range(1,N+1):
-                a[(i,j)] = totalC_j_Minus_iOverAllObservations[(i,j)]/totalC_l_Minus_iOverAllObservations[i]
-            '''
-        #a[(i,j,I)] = p(j|i,I)
-        #for (i, j, I) in totalC_j_Minus_iOverAllObservations:
+        #a[(i,j,I)] = p(j|i,I), from the jump histogram of target length I
         for I in target_length_map:
-            for i in range(1,I+1):
-                for j in range(1,I+1):
-                    a[(i,j,I)] = (1-p0H)*totalC_j_Minus_iOverAllObservations[(i,j,I)]/totalC_l_Minus_iOverAllObservations[i,I]
-
-        for I in target_length_map:
-            for i in range(1,I+1):
-                for j in range(1,I+1):
-                    a[i][i + I][I] = p0H
-                    a[i + I][i + I][I] = p0H
-
-        for I in target_length_map:
-            for i in range(1,N+1):
-                for j in range(1,N+1):
-                    a[i+I][j][I] = a[i][j][I]
-
-         #************RUN IT ON TWON
-        #normalize_table(a)
-        for I in target_length_map:
-            smooth_transition_probabilities(a, I)
+            if I > 0:
+                transition_probabilities(a, I, totalJumpHistogramsOverAllObservations[jump_histogram_slice(I)], window)
 
         '''for I in target_length_map:
             check_probability(a, I)
@@ -583,14 +615,73 @@ def baumWelchP(bitext_sd, s_count,t_table,sd_count):#L is the number of observat
         #check_probability(a, N)
         for k in range(sd_size):
             (f,e) = biword[k]
-            t_table[(f,e)] = totalGammaDeltaOverAllObservations_t_overall_states[k]/totalGammaDeltaOverAllObservations_t_overall_states_over_dest[e]
+            if totalGammaDeltaOverAllObservations_t_overall_states_over_dest[e] > 0:
+                t_table[(f,e)] = totalGammaDeltaOverAllObservations_t_overall_states[k]/totalGammaDeltaOverAllObservations_t_overall_states_over_dest[e]
+            else:
+                #Every state of e was pruned away: e keeps its last probabilities
+                t_table[(f,e)] = last_t_table[(f,e)]
+        if batched:
+            t_events = event_probabilities(t_table, sd_count)
         endTime = time.time()
         print "run time for one iteration of hmm_with_length_with_array parallel model %.2gs" % (endTime - startTime)
 
         print iterations
+        if schedule.heldout is not None:
+            schedule.end_iteration(logLikelihood, *heldout_log_likelihood(a, pi, t_table, schedule.heldout, window))
+            if schedule.improved():
+                best = (a,t_table,pi)
+        else:
+            schedule.end_iteration(logLikelihood)
 
+    if best is not None:
+        return best
     return (a,t_table,pi)
 
+def heldout_log_likelihood(a, pi, t_table, bitext, window=None):
+    # Log-likelihood of held-out pairs with the same forward pass as the E step and the number of
+    # source tokens scored. Word pairs t_table has never seen get HELDOUT_FLOOR; sentences whose
+    # target length has no transition table are skipped.
+    logLikelihood = 0.0
+    tokens = 0
+    for (y,x) in bitext:
+        T = len(y)
+        N = len(x)
+        if T == 0 or N == 0 or N >= a.shape[2] or not a[1:N+1,1:N+1,N].any():
+            continue
+        emission = np.array([[t_table.get((y_t,x_j),0) for x_j in x] for y_t in y])
+        emission = np.maximum(emission, HELDOUT_FLOOR)
+        if window is not None and N >= BANDED_MIN_STATES:
+            (alpha_hat, c_scaled) = forward_scaled_banded(band_structure(a[1:N+1,1:N+1,N], window), pi[1:N+1], emission)
+        else:
+            (alpha_hat, c_scaled) = forward_scaled(a[1:N+1,1:N+1,N], pi[1:N+1], emission)
+        logLikelihood += -log(c_scaled[1:]).sum()
+        tokens += T
+    return (logLikelihood, tokens)
+
+def pruning_error(a, pi, t_table, bitext, threshold, first_iteration=False, jump_prior=None, window=None):
+    # Number of pairs scored and how much lower their log-likelihood is under pruning with
+    # threshold than under the exact forward_with_t_scaled, with the parameters of the E step
+    # that just ran: in the first iteration, the initialization of every target length
+    error = 0.0
+    sentences = 0
+    for (y,x) in bitext:
+        T = len(y)
+        N = len(x)
+        if T == 0 or N == 0:
+            continue
+        if first_iteration:
+            if jump_prior is not None:
+                (a, pi) = initializeBasedOnJumps(N, jump_prior, window)
+            else:
+                (a, pi) = initializeUniformly(N)
+        if N >= a.shape[2]:
+            continue
+        (alpha_hat, c_scaled) = forward_with_t_scaled(a, pi, y, N, T, x, t_table)
+        (alpha_hat, c_pruned, kept) = forward_scaled_pruned(a[1:N+1,1:N+1,N], pi[1:N+1], emission_matrix(t_table, y, x), threshold)
+        error += log(c_pruned[1:]).sum() - log(c_scaled[1:]).sum()
+        sentences += 1
+    return (sentences, error)
+
 def check_probability(p, N):
     for i in range(1,2*N+1):
         total = 0
@@ -602,6 +693,9 @@ def check_probability(p, N):
             print "YEEEESSSS ", total
 
 def log_viterbi(a,t_table,pi,N,o,d):
+    #An empty source or target line has no alignment
+    if len(o) == 0 or N == 0:
+        return []
     V = zeros((2*N+1,len(o)))
     ptr = zeros((2*N+1,len(o)))
     newd = []
@@ -662,6 +756,38 @@ def log_viterbi(a,t_table,pi,N,o,d):
         i = i -1
     return trace
 
+def viterbi_banded(a,t_table,N,o,d,window):
+    # log_viterbi for transitions trained with a jump window. The 2N x 2N transitions are four
+    # N x N blocks: into real states they are banded with the window, into null states banded
+    # with width 0 (the null state of the same position, the smoothing floor elsewhere), so
+    # every step is O(N*window). Returns the states 1..2N like log_viterbi.
+    T = len(o)
+    if T == 0 or N == 0:
+        return []
+    with np.errstate(divide='ignore'):
+        emission = log(np.array([[t_table.get((o_t,d_j),0) for d_j in d] for o_t in o], dtype=np.float64).reshape((T,N)))
+    null = log(null_emission_prob)
+    #blocks[p][q]: from real (p=0) or null (p=1) states into real (q=0) or null (q=1) states
+    blocks = [[log_band(band_structure(a[p*N+1:p*N+N+1, q*N+1:q*N+N+1, N], window if q == 0 else 0)) for q in (0,1)] for p in (0,1)]
+    V = np.concatenate((emission[0], np.full(N, null)))
+    ptr = zeros((T,2*N), dtype=int)
+    for t in xrange(1,T):
+        new_V = np.empty(2*N)
+        for q in (0,1):
+            (from_real, real_at) = banded_max_plus(V[:N], blocks[0][q])
+            (from_null, null_at) = banded_max_plus(V[N:], blocks[1][q])
+            new_V[q*N:q*N+N] = np.maximum(from_real, from_null)
+            ptr[t,q*N:q*N+N] = np.where(from_null > from_real, null_at + N, real_at)
+        new_V[:N] += emission[t]
+        new_V[N:] += null
+        V = new_V
+    q = int(V.argmax())
+    trace = [q+1]
+    for t in xrange(T-1,0,-1):
+        q = ptr[t,q]
+        trace.insert(0, q+1)
+    return trace
+
 def findBestAlignmentsForAll(bitext,a,t_table,pi):
     for (n,(S,D)) in enumerate(bitext):
 
@@ -672,12 +798,18 @@ def findBestAlignmentsForAll(bitext,a,t_table,pi):
         sys.stdout.write("\n")
 
 
-def findBestAlignmentsForAll_AER(bitext,a,t_table,pi,num_lines,alignmentFile):
+def findBestAlignmentsForAll_AER(bitext,a,t_table,pi,num_lines,alignmentFile,window=None):
     alignment = open(alignmentFile,'w')
     for (n,(S,D)) in enumerate(bitext):
         N = len(D)
 
-        bestAlignment = log_viterbi(a, t_table, pi, N, S, D)
+        #Sentences longer than any length seen in training (see the length policy) have no transition table
+        if N < a.shape[2] and window is not None:
+            bestAlignment = viterbi_banded(a, t_table, N, S, D, window)
+        elif N < a.shape[2]:
+            bestAlignment = log_viterbi(a, t_table, pi, N, S, D)
+        else:
+            bestAlignment = []
         for (i,a_i) in enumerate(bestAlignment):
             #CHANGE for null
             if a_i <= N:
@@ -721,15 +853,22 @@ def findBestAlignmentsForAllWithIntersection(bitext,a,b,pi,a_ds,b_ds,pi_ds):
         for (i_s,a_s) in intersect:
             sys.stdout.write("%i-%i " % (i_s,a_s))
         sys.stdout.write("\n")
-def findBestAlignmentsForAllWithIntersection_AER(bitext,a,b,pi,a_ds,b_ds,pi_ds,num_lines,alignmentFile):
+def findBestAlignmentsForAllWithIntersection_AER(bitext,a,b,pi,a_ds,b_ds,pi_ds,num_lines,alignmentFile,window=None):
     alignment = open(alignmentFile,'w')
     for (n,(S,D)) in enumerate(bitext):
         set1 = set()
         set2 = set()
         N = len(D)
         N_ds = len(S)
-        bestAlignment = log_viterbi(a, b, pi, N, S, D)
-        bestAlignment_ds = log_viterbi(a_ds, b_ds, pi_ds, N_ds, D, S)
+        #Sentences longer than any length seen in training have no transition table in that direction
+        if N < a.shape[2] and N_ds < a_ds.shape[2] and window is not None:
+            bestAlignment = viterbi_banded(a, b, N, S, D, window)
+            bestAlignment_ds = viterbi_banded(a_ds, b_ds, N_ds, D, S, window)
+        elif N < a.shape[2] and N_ds < a_ds.shape[2]:
+            bestAlignment = log_viterbi(a, b, pi, N, S, D)
+            bestAlignment_ds = log_viterbi(a_ds, b_ds, pi_ds, N_ds, D, S)
+        else:
+            (bestAlignment, bestAlignment_ds) = ([], [])
         for (i,a_i) in enumerate(bestAlignment):
             set1.add((i,a_i-1))
         for (i,a_i) in enumerate(bestAlignment_ds):
@@ -4,18 +4,32 @@
 __author__ = 'amansour'
 
 from collections import defaultdict
+from itertools import islice
+from multiprocessing import Process, Array
+from math import log
+import ctypes as ct
+import numpy as np
 
-def EM_IBM1(source_count, target_count, st_count,bitext):
+from corpus import Vocabulary, intern_bitext
+from t_table import t_table_from_events
+from em_schedule import EMSchedule, HELDOUT_FLOOR
+
+def EM_IBM1(source_count, target_count, st_count,bitext,schedule=None):
     c = defaultdict(int)
     total = defaultdict(int)
     t = defaultdict(int)
+    if schedule is None:
+        schedule = EMSchedule('IBM1')
 
     #initialize t uniformly
     for (source,target) in st_count:
         t[(source,target)] = 1.0/len(source_count)
-    for cnt in range(10):
+    #The table of the iteration with the best held-out perplexity (see EMSchedule)
+    best_t = None
+    for cnt in schedule:
         c = defaultdict(int)
         total = defaultdict(int)
+        logLikelihood = 0.0
 
         for (S,D) in bitext:
             for s_i in S:
@@ -25,8 +39,514 @@ def EM_IBM1(source_count, target_count, st_count,bitext):
                 for d_j in D:
                     c[(s_i,d_j)] += t[(s_i,d_j)]/Z
                     total[d_j] += t[(s_i,d_j)]/Z
+                #Pairs with an empty target side are not scored, as in EM_IBM1_vectorized
+                if len(D) > 0:
+                    logLikelihood += log(Z/len(D))
         for (s,d) in st_count:
             t[(s,d)] = c[(s,d)]/total[d]
+        if schedule.heldout is not None:
+            schedule.end_iteration(logLikelihood, *IBM1_log_likelihood(t, schedule.heldout))
+            if schedule.improved():
+                best_t = defaultdict(int, t)
+        else:
+            schedule.end_iteration(logLikelihood)
+    if best_t is not None:
+        return best_t
     return t
 
+def IBM1_log_likelihood(t, bitext):
+    # Log-likelihood of bitext under the table t (a dict or a SparseTTable) and the number of
+    # source tokens scored. Pairs missing from t get HELDOUT_FLOOR.
+    logLikelihood = 0.0
+    tokens = 0
+    for (S,D) in bitext:
+        if len(D) == 0:
+            continue
+        for s_i in S:
+            Z = 0
+            for d_j in D:
+                Z += max(t.get((s_i,d_j), 0), HELDOUT_FLOOR)
+            logLikelihood += log(Z/len(D))
+        tokens += len(S)
+    return (logLikelihood, tokens)
+
+# Largest number of (source token, target token) cells handled at once by the vectorized engines
+MAX_BLOCK_CELLS = 1 << 22
+
+def block_bounds(bitext, max_cells=MAX_BLOCK_CELLS):
+    # Splits the corpus into runs of consecutive sentences with at most max_cells T*N cells each
+    # (a single longer sentence gets a run of its own)
+    cells = np.cumsum(bitext.source_lengths() * bitext.target_lengths())
+    bounds = [0]
+    while bounds[-1] < len(bitext):
+        done = cells[bounds[-1]-1] if bounds[-1] > 0 else 0
+        end = np.searchsorted(cells, done + max_cells, side='right')
+        bounds.append(max(end, bounds[-1] + 1))
+    return zip(bounds[:-1], bounds[1:])
+
+def cell_positions(bitext, start, end):
+    # The posterior blocks of sentences start..end-1 flattened: cell k pairs source token
+    # rows[k] with target token columns[k] of the same sentence, both numbered from 0 within the run
+    source_offsets = bitext.source_offsets[start:end+1]
+    target_offsets = bitext.target_offsets[start:end+1]
+    T = np.diff(source_offsets)
+    N = np.diff(target_offsets)
+    sentence = np.repeat(np.arange(end - start), T)
+    repeats = N[sentence]
+    rows = np.repeat(np.arange(len(sentence)), repeats)
+    block_start = np.repeat(np.cumsum(repeats) - repeats, repeats)
+    columns = np.arange(len(rows)) - block_start + np.repeat(target_offsets[:-1][sentence] - target_offsets[0], repeats)
+    return (rows, columns)
+
+def sentence_cells(bitext, start, end):
+    # cell_positions with sources[k] and targets[k] the two words of cell k
+    (rows, columns) = cell_positions(bitext, start, end)
+    sources = bitext.source_tokens[bitext.source_offsets[start] + rows]
+    targets = bitext.target_tokens[bitext.target_offsets[start] + columns]
+    return (rows, sources, targets)
+
+def sentence_blocks(bitext, sd_count, start, end):
+    # sentence_cells with pairs[k] the event id of the two words in sd_count
+    (rows, sources, targets) = sentence_cells(bitext, start, end)
+    return (rows, sd_count.pair_ids(sources, targets))
+
+def IBM1_counts(bitext, st_count, t, blocks, c, ll):
+    # IBM1 E-step over the given runs of sentences, accumulated into c, with the
+    # log-likelihood of the runs added to ll[0]
+    for (start, end) in blocks:
+        (rows, pairs) = sentence_blocks(bitext, st_count, start, end)
+        p = t[pairs]
+        Z = np.bincount(rows, weights=p)
+        c += np.bincount(pairs, weights=p/Z[rows], minlength=len(c))
+        N = np.bincount(rows)
+        scored = N > 0
+        ll[0] += np.log(Z[scored]/N[scored]).sum()
+
+def parallel_counts(counts, args, blocks, processes, c_workers, stats_workers):
+    # Runs counts(*args, blocks[k::processes], c_workers[k], stats_workers[k]) for every k in a
+    # process of its own and returns the sums over the workers of c_workers and stats_workers.
+    # A worker that fails raises here rather than leaving its share of the counts at 0.
+    c_workers.fill(0.0)
+    stats_workers.fill(0.0)
+    jobs = []
+    for k in range(processes):
+        p = Process(target=counts, args=args + (blocks[k::processes], c_workers[k], stats_workers[k]))
+        p.start()
+        jobs.append(p)
+    for p in jobs:
+        p.join()
+    failed = [p for p in jobs if p.exitcode != 0]
+    if failed:
+        raise RuntimeError("%s worker %s exited with code %d" % (counts.__name__, failed[0].name, failed[0].exitcode))
+    return (c_workers.sum(axis=0), stats_workers.sum(axis=0))
+
+def IBM1_blocks_log_likelihood(heldout_blocks, t):
+    # IBM1_log_likelihood over blocks of (rows, pairs) precomputed with sentence_blocks,
+    # where pairs never seen in training have the event id -1
+    logLikelihood = 0.0
+    tokens = 0
+    for (rows, pairs) in heldout_blocks:
+        p = np.maximum(np.where(pairs >= 0, t[pairs], 0.0), HELDOUT_FLOOR)
+        Z = np.bincount(rows, weights=p)
+        N = np.bincount(rows)
+        scored = N > 0
+        logLikelihood += np.log(Z[scored]/N[scored]).sum()
+        tokens += int(scored.sum())
+    return (logLikelihood, tokens)
+
+def EM_IBM1_vectorized(source_count, st_count, bitext, schedule=None, processes=1):
+    # Same model and updates as EM_IBM1, over an interned Corpus and a PairCountView.
+    # t is kept as one array indexed by event id, counts are scattered with bincount.
+    # With several processes every worker fills its own row of a shared count buffer
+    # for its share of the corpus and the rows are summed before normalization.
+    if schedule is None:
+        schedule = EMSchedule('IBM1')
+    num_events = len(st_count)
+    event_targets = st_count.event_targets()
+    t = np.empty(num_events)
+    t.fill(1.0/len(source_count))
+    if processes > 1:
+        #Small enough runs that every worker gets several of them
+        total_cells = int((bitext.source_lengths() * bitext.target_lengths()).sum())
+        blocks = block_bounds(bitext, min(MAX_BLOCK_CELLS, total_cells/(4*processes) + 1))
+        c_array = Array(ct.c_double, processes*num_events, lock=False)
+        c_workers = np.frombuffer(c_array).reshape((processes, num_events))
+        ll_workers = np.frombuffer(Array(ct.c_double, processes, lock=False)).reshape((processes, 1))
+        #Computed once here rather than in every worker
+        st_count.event_keys()
+    else:
+        blocks = block_bounds(bitext)
+    if schedule.heldout is not None:
+        heldout_blocks = [sentence_blocks(schedule.heldout, st_count, start, end) for (start, end) in block_bounds(schedule.heldout)]
+    best_t = None
+    for cnt in schedule:
+        if processes > 1:
+            (c, ll) = parallel_counts(IBM1_counts, (bitext, st_count, t), blocks, processes, c_workers, ll_workers)
+            logLikelihood = ll[0]
+        else:
+            c = np.zeros(num_events)
+            ll = np.zeros(1)
+            IBM1_counts(bitext, st_count, t, blocks, c, ll)
+            logLikelihood = ll[0]
+        total = np.bincount(event_targets, weights=c)
+        t = c/total[event_targets]
+        if schedule.heldout is not None:
+            schedule.end_iteration(logLikelihood, *IBM1_blocks_log_likelihood(heldout_blocks, t))
+            if schedule.improved():
+                best_t = t
+        else:
+            schedule.end_iteration(logLikelihood)
+    if best_t is not None:
+        t = best_t
+    return t_table_from_events(st_count.event_sources(), event_targets, t, st_count.num_targets())
+
+def bidirectional_counts(bitext, st_count, t_st, t_ts, blocks, c, ll):
+    # E-steps of both directions over the same cells: rows normalize t_st(s|d) over the targets
+    # of a source token, columns normalize t_ts(d|s) over the sources of a target token.
+    # Counts go to c[0] and c[1], log-likelihoods to ll[0] and ll[1].
+    for (start, end) in blocks:
+        (rows, columns) = cell_positions(bitext, start, end)
+        pairs = st_count.pair_ids(bitext.source_tokens[bitext.source_offsets[start] + rows],
+                                  bitext.target_tokens[bitext.target_offsets[start] + columns])
+        for (k, t, groups) in ((0, t_st, rows), (1, t_ts, columns)):
+            p = t[pairs]
+            Z = np.bincount(groups, weights=p)
+            c[k] += np.bincount(pairs, weights=p/Z[groups], minlength=c.shape[1])
+            N = np.bincount(groups)
+            scored = N > 0
+            ll[k] += np.log(Z[scored]/N[scored]).sum()
+
+def EM_IBM1_bidirectional(source_count, target_count, st_count, bitext, schedule=None, processes=1):
+    # EM_IBM1_vectorized for both directions at once: every run of sentences is expanded into
+    # its cells and event ids once, and both E-steps read them. Both tables are indexed by the
+    # event ids of st_count; t_ts is normalized by source word instead of by target word.
+    # The schedule sees the sum of the two log-likelihoods.
+    # Returns (t_st, t_ts), the second keyed by (d, s) like a table trained on bitext.reverse().
+    if schedule is None:
+        schedule = EMSchedule('IBM1 bidirectional')
+    ts_count = st_count.counts.view(not st_count.reverse)
+    num_events = len(st_count)
+    event_sources = st_count.event_sources()
+    event_targets = st_count.event_targets()
+    t_st = np.empty(num_events)
+    t_st.fill(1.0/len(source_count))
+    t_ts = np.empty(num_events)
+    t_ts.fill(1.0/len(target_count))
+    if processes > 1:
+        total_cells = int((bitext.source_lengths() * bitext.target_lengths()).sum())
+        blocks = block_bounds(bitext, min(MAX_BLOCK_CELLS, total_cells/(4*processes) + 1))
+        c_array = Array(ct.c_double, processes*2*num_events, lock=False)
+        c_workers = np.frombuffer(c_array).reshape((processes, 2, num_events))
+        ll_workers = np.frombuffer(Array(ct.c_double, processes*2, lock=False)).reshape((processes, 2))
+        st_count.event_keys()
+    else:
+        blocks = block_bounds(bitext)
+    if schedule.heldout is not None:
+        heldout_blocks = [sentence_blocks(schedule.heldout, st_count, start, end) for (start, end) in block_bounds(schedule.heldout)]
+        heldout_reverse = schedule.heldout.reverse()
+        reverse_blocks = [sentence_blocks(heldout_reverse, ts_count, start, end) for (start, end) in block_bounds(heldout_reverse)]
+    best = None
+    for cnt in schedule:
+        if processes > 1:
+            (c, ll) = parallel_counts(bidirectional_counts, (bitext, st_count, t_st, t_ts), blocks, processes, c_workers, ll_workers)
+            logLikelihood = ll.sum()
+        else:
+            c = np.zeros((2, num_events))
+            ll = np.zeros(2)
+            bidirectional_counts(bitext, st_count, t_st, t_ts, blocks, c, ll)
+            logLikelihood = ll.sum()
+        t_st = c[0]/np.bincount(event_targets, weights=c[0])[event_targets]
+        t_ts = c[1]/np.bincount(event_sources, weights=c[1])[event_sources]
+        if schedule.heldout is not None:
+            (heldout_st, tokens_st) = IBM1_blocks_log_likelihood(heldout_blocks, t_st)
+            (heldout_ts, tokens_ts) = IBM1_blocks_log_likelihood(reverse_blocks, t_ts)
+            schedule.end_iteration(logLikelihood, heldout_st + heldout_ts, tokens_st + tokens_ts)
+            if schedule.improved():
+                best = (t_st, t_ts)
+        else:
+            schedule.end_iteration(logLikelihood)
+    if best is not None:
+        (t_st, t_ts) = best
+    return (t_table_from_events(event_sources, event_targets, t_st, st_count.num_targets()),
+            t_table_from_events(event_targets, event_sources, t_ts, ts_count.num_targets()))
+
+# fast_align (Dyer et al., 2013): a(j|i,m,n) proportional to exp(tension * -|i/m - j/n|)
+DIAGONAL_TENSION = 4.0
+MIN_TENSION = 0.1
+MAX_TENSION = 14.0
+TENSION_STEPS = 8
+TENSION_RATE = 20.0
+
+def diagonal_cells(bitext, start, end):
+    # For the source token rows of sentence_blocks(bitext, ..., start, end): the 1-based source
+    # position i, source length m and target length n of every row, and for every cell the
+    # feature -|i/m - j/n| of the row's token and the cell's target position j
+    T = np.diff(bitext.source_offsets[start:end+1])
+    N = np.diff(bitext.target_offsets[start:end+1])
+    sentence = np.repeat(np.arange(end - start), T)
+    row_i = np.arange(len(sentence)) - np.repeat(np.cumsum(T) - T, T) + 1
+    row_m = T[sentence]
+    row_n = N[sentence]
+    rows = np.repeat(np.arange(len(sentence)), row_n)
+    cell_j = np.arange(len(rows)) - np.repeat(np.cumsum(row_n) - row_n, row_n) + 1
+    h = -np.abs(row_i[rows]/row_m[rows].astype(float) - cell_j/row_n[rows].astype(float))
+    return (row_i, row_m, row_n, h)
+
+def diagonal_normalizer(i, m, n, tension):
+    # Sum over j=1..n of exp(tension * -|i/m - j/n|) for arrays of rows (i, m, n), in closed form:
+    # the terms on either side of j = i*n/m are geometric series with ratio exp(-tension/n)
+    n = np.maximum(n, 1).astype(float)
+    split = i*n/m
+    floor = np.floor(split)
+    ratio = np.exp(-tension/n)
+    num_top = n - floor
+    top = np.exp(-tension*np.abs(i/m.astype(float) - (floor + 1)/n))*(1.0 - ratio**num_top)/(1.0 - ratio)
+    bottom = np.exp(-tension*np.abs(i/m.astype(float) - floor/n))*(1.0 - ratio**floor)/(1.0 - ratio)
+    return np.where(num_top > 0, top, 0.0) + np.where(floor > 0, bottom, 0.0)
+
+def arithmetico_geometric_series(a_1, g_1, r, d, n):
+    # Sum over k=0..n-1 of (a_1 + k*d)*g_1*r^k
+    g_np1 = g_1*r**n
+    a_n = d*(n - 1) + a_1
+    x_1 = a_1*g_1
+    g_2 = g_1*r
+    rm1 = r - 1
+    return (a_n*g_np1 - x_1)/rm1 - d*(g_np1 - g_2)/(rm1*rm1)
+
+def diagonal_expected_feature(i, m, n, tension):
+    # Expectation of -|i/m - j/n| under a(j|i,m,n) for arrays of rows (i, m, n), in closed form
+    n = np.maximum(n, 1).astype(float)
+    m = m.astype(float)
+    split = i*n/m
+    floor = np.floor(split)
+    ratio = np.exp(-tension/n)
+    num_top = n - floor
+    top_feature = -np.abs(i/m - (floor + 1)/n)
+    bottom_feature = -np.abs(i/m - floor/n)
+    top = arithmetico_geometric_series(top_feature, np.exp(tension*top_feature), ratio, -1.0/n, num_top)
+    bottom = arithmetico_geometric_series(bottom_feature, np.exp(tension*bottom_feature), ratio, -1.0/n, floor)
+    total = np.where(num_top > 0, top, 0.0) + np.where(floor > 0, bottom, 0.0)
+    return total/diagonal_normalizer(i, m, n, tension)
+
+def diagonal_posteriors(bitext, st_count, t, tension, start, end):
+    # Alignment posteriors of the cells of sentence_blocks under t and the diagonal prior,
+    # with the per-row normalizers and the cell features
+    (rows, pairs) = sentence_blocks(bitext, st_count, start, end)
+    (row_i, row_m, row_n, h) = diagonal_cells(bitext, start, end)
+    prior = np.exp(tension*h)/diagonal_normalizer(row_i, row_m, row_n, tension)[rows]
+    p = t[pairs]*prior
+    Z = np.bincount(rows, weights=p, minlength=len(row_i))
+    return (rows, pairs, p/Z[rows], Z, row_n, h)
+
+def IBM2_counts(bitext, st_count, t, tension, blocks, c, stats):
+    # Diagonal IBM2 E-step over the given runs of sentences, accumulated into c;
+    # stats[0] gets the log-likelihood and stats[1] the expected feature value
+    for (start, end) in blocks:
+        (rows, pairs, posterior, Z, row_n, h) = diagonal_posteriors(bitext, st_count, t, tension, start, end)
+        c += np.bincount(pairs, weights=posterior, minlength=len(c))
+        stats[0] += np.log(Z[row_n > 0]).sum()
+        stats[1] += (posterior*h).sum()
+
+def IBM2_heldout_log_likelihood(heldout, st_count, t, tension):
+    # Like IBM1_blocks_log_likelihood with the diagonal prior in place of 1/n
+    logLikelihood = 0.0
+    tokens = 0
+    for (start, end) in block_bounds(heldout):
+        (rows, pairs) = sentence_blocks(heldout, st_count, start, end)
+        (row_i, row_m, row_n, h) = diagonal_cells(heldout, start, end)
+        prior = np.exp(tension*h)/diagonal_normalizer(row_i, row_m, row_n, tension)[rows]
+        p = np.maximum(np.where(pairs >= 0, t[pairs], 0.0), HELDOUT_FLOOR)*prior
+        Z = np.bincount(rows, weights=p, minlength=len(row_i))
+        logLikelihood += np.log(Z[row_n > 0]).sum()
+        tokens += int((row_n > 0).sum())
+    return (logLikelihood, tokens)
+
+def jump_counts(bitext, st_count, t, tension, blocks):
+    # Expected jumps j'-j between the targets of consecutive source words under the final
+    # posteriors, as a c[d] histogram like compute_c() for the HMM to start from.
+    # Model 2 aligns words independently, so for one sentence with T x N posteriors P the
+    # jump counts are the diagonal sums of P[:-1]^T P[1:].
+    jumps = defaultdict(int)
+    for (start, end) in blocks:
+        (rows, pairs, posterior, Z, row_n, h) = diagonal_posteriors(bitext, st_count, t, tension, start, end)
+        T = np.diff(bitext.source_offsets[start:end+1])
+        N = np.diff(bitext.target_offsets[start:end+1])
+        cell = 0
+        for (m, n) in zip(T.tolist(), N.tolist()):
+            if m > 1 and n > 0:
+                P = posterior[cell:cell + m*n].reshape((m, n))
+                K = P[:-1].T.dot(P[1:])
+                (i, j) = np.indices((n, n))
+                histogram = np.bincount((j - i).ravel() + n - 1, weights=K.ravel())
+                for (d, value) in enumerate(histogram.tolist()):
+                    jumps[d - n + 1] += value
+            cell += m*n
+    total = sum(jumps.values())
+    for d in jumps:
+        jumps[d] /= total
+    return jumps
+
+def EM_IBM2_diagonal(source_count, st_count, bitext, schedule=None, processes=1, tension=DIAGONAL_TENSION):
+    # fast_align-style IBM2: IBM1 translation tables with the diagonal alignment prior
+    # a(j|i,m,n) instead of 1/n, at the cost of one more exp per cell. The tension is
+    # re-estimated after every E step with a few gradient steps; the model expectation it
+    # needs depends only on (i, m, n), so it is computed once per distinct length pair.
+    # Returns the t table and a jump prior c[d] for baumWelchP.
+    if schedule is None:
+        schedule = EMSchedule('IBM2')
+    num_events = len(st_count)
+    event_targets = st_count.event_targets()
+    t = np.empty(num_events)
+    t.fill(1.0/len(source_count))
+
+    #Distinct (m, n) length pairs, with one row per source position of each
+    lengths = bitext.source_lengths().astype(np.int64)*(bitext.target_lengths().max() + 1) + bitext.target_lengths()
+    (length_pairs, pair_count) = np.unique(lengths, return_counts=True)
+    (m, n) = np.divmod(length_pairs, bitext.target_lengths().max() + 1)
+    row_pair = np.repeat(np.arange(len(m)), m)
+    row_i = np.arange(len(row_pair)) - np.repeat(np.cumsum(m) - m, m) + 1
+    (row_m, row_n, row_weight) = (m[row_pair], n[row_pair], pair_count[row_pair])
+    scored = row_n > 0
+    (row_i, row_m, row_n, row_weight) = (row_i[scored], row_m[scored], row_n[scored], row_weight[scored])
+    tokens = row_weight.sum()
+
+    if processes > 1:
+        total_cells = int((bitext.source_lengths() * bitext.target_lengths()).sum())
+        blocks = block_bounds(bitext, min(MAX_BLOCK_CELLS, total_cells/(4*processes) + 1))
+        c_array = Array(ct.c_double, processes*num_events, lock=False)
+        c_workers = np.frombuffer(c_array).reshape((processes, num_events))
+        stats_workers = np.frombuffer(Array(ct.c_double, processes*2, lock=False)).reshape((processes, 2))
+        st_count.event_keys()
+    else:
+        blocks = block_bounds(bitext)
+    best = None
+    for cnt in schedule:
+        if processes > 1:
+            (c, (logLikelihood, empirical_feature)) = parallel_counts(IBM2_counts, (bitext, st_count, t, tension), blocks, processes, c_workers, stats_workers)
+        else:
+            c = np.zeros(num_events)
+            stats = np.zeros(2)
+            IBM2_counts(bitext, st_count, t, tension, blocks, c, stats)
+            (logLikelihood, empirical_feature) = stats
+        total = np.bincount(event_targets, weights=c)
+        t = c/total[event_targets]
+        for step in range(TENSION_STEPS):
+            model_feature = (row_weight*diagonal_expected_feature(row_i, row_m, row_n, tension)).sum()
+            tension += (empirical_feature - model_feature)/tokens*TENSION_RATE
+            tension = min(max(tension, MIN_TENSION), MAX_TENSION)
+        if schedule.log is not None:
+            schedule.log.write("IBM2 diagonal tension %f\n" % tension)
+        if schedule.heldout is not None:
+            schedule.end_iteration(logLikelihood, *IBM2_heldout_log_likelihood(schedule.heldout, st_count, t, tension))
+            if schedule.improved():
+                best = (t, tension)
+        else:
+            schedule.end_iteration(logLikelihood)
+    if best is not None:
+        (t, tension) = best
+    jump_prior = jump_counts(bitext, st_count, t, tension, block_bounds(bitext))
+    return (t_table_from_events(st_count.event_sources(), event_targets, t, st_count.num_targets()), jump_prior)
+
+# Stepwise EM (Liang and Klein, 2009): mini-batch k is interpolated with step size (k+2)^-STEP_DECAY
+STEP_DECAY = 0.7
+BATCH_SIZE = 10000
+# Expected counts of the online engine are keyed by source << 32 | target
+TARGET_BITS = 32
+TARGET_MASK = (1 << TARGET_BITS) - 1
+
+def stream_batches(open_stream, batch_size, source_vocab, target_vocab):
+    # Interned mini-batches of batch_size pairs from a fresh stream of (source words, target words)
+    stream = iter(open_stream())
+    batch = intern_bitext(islice(stream, batch_size), source_vocab, target_vocab)
+    while len(batch):
+        yield batch
+        batch = intern_bitext(islice(stream, batch_size), source_vocab, target_vocab)
+
+def EM_IBM1_online(open_stream, source_vocab=None, target_vocab=None, schedule=None, batch_size=BATCH_SIZE, step_decay=STEP_DECAY, max_events=None):
+    # Stepwise online EM for IBM1. open_stream() returns an iterable of (source words, target
+    # words), e.g. lambda: read_bitext(f_file, e_file), and is opened again for every pass of
+    # the schedule. Only the current mini-batch and the expected counts mu are in memory.
+    # After mini-batch k
+    #   mu = (1 - eta_k)*mu + eta_k*(expected counts of the batch),  eta_k = (k+2)^-step_decay
+    # and t(s|d) = mu(s,d)/sum_s mu(s,d); pairs not in mu get 1/|source vocab| as in EM_IBM1.
+    # mu is a sorted array of keys source << 32 | target, which stay valid while the
+    # vocabularies grow, with the counts in a parallel array. With max_events set, the
+    # smallest counts are dropped whenever there are more pairs than that.
+    # Returns the SparseTTable and the two vocabularies, which the batches may have extended.
+    if schedule is None:
+        schedule = EMSchedule('IBM1 online')
+    if source_vocab is None:
+        source_vocab = Vocabulary()
+    if target_vocab is None:
+        target_vocab = Vocabulary()
+    keys = np.zeros(0, dtype=np.int64)
+    mu = np.zeros(0)
+    total = np.zeros(len(target_vocab))
+    k = 0
+    best_t = None
+
+    def table():
+        targets = keys & TARGET_MASK
+        return t_table_from_events(keys >> TARGET_BITS, targets, mu/total[targets], len(target_vocab))
+
+    for cnt in schedule:
+        logLikelihood = 0.0
+        for batch in stream_batches(open_stream, batch_size, source_vocab, target_vocab):
+            (rows, sources, targets) = sentence_cells(batch, 0, len(batch))
+            (batch_keys, inverse) = np.unique((sources.astype(np.int64) << TARGET_BITS) | targets, return_inverse=True)
+            batch_targets = batch_keys & TARGET_MASK
+            if len(total) < len(target_vocab):
+                total = np.concatenate((total, np.zeros(len(target_vocab) - len(total))))
+
+            #E step on the batch with the current t
+            position = np.searchsorted(keys, batch_keys)
+            known = position < len(keys)
+            known[known] = keys[position[known]] == batch_keys[known]
+            t = np.empty(len(batch_keys))
+            t.fill(1.0/len(source_vocab))
+            t[known] = mu[position[known]]/total[batch_targets[known]]
+            p = t[inverse]
+            Z = np.bincount(rows, weights=p)
+            counts = np.bincount(inverse, weights=p/Z[rows], minlength=len(batch_keys))
+            N = np.bincount(rows)
+            scored = N > 0
+            logLikelihood += np.log(Z[scored]/N[scored]).sum()
+
+            #Interpolate the batch counts into mu, inserting the new pairs in key order
+            eta = (k + 2) ** -step_decay
+            k += 1
+            mu *= 1 - eta
+            total *= 1 - eta
+            total += eta*np.bincount(batch_targets, weights=counts, minlength=len(total))
+            mu[position[known]] += eta*counts[known]
+            keys = np.insert(keys, position[~known], batch_keys[~known])
+            mu = np.insert(mu, position[~known], eta*counts[~known])
+
+            if max_events is not None and len(keys) > max_events:
+                dropped = np.ones(len(keys), dtype=bool)
+                dropped[np.argpartition(-mu, max_events)[:max_events]] = False
+                total -= np.bincount(keys[dropped] & TARGET_MASK, weights=mu[dropped], minlength=len(total))
+                keys = keys[~dropped]
+                mu = mu[~dropped]
+        if schedule.heldout is not None:
+            current = table()
+            schedule.end_iteration(logLikelihood, *IBM1_log_likelihood(current, schedule.heldout))
+            if schedule.improved():
+                best_t = current
+        else:
+            schedule.end_iteration(logLikelihood)
+    if best_t is not None:
+        return (best_t, source_vocab, target_vocab)
+    return (table(), source_vocab, target_vocab)
 
+def t_table_over_events(t, st_count, floor):
+    # t (e.g. of EM_IBM1_online) on every event of st_count, with floor for the events t does
+    # not have, like the online E step scores the pairs max_events dropped
+    sources = st_count.event_sources()
+    targets = st_count.event_targets()
+    position = t.positions(sources, targets)
+    found = position >= 0
+    probs = np.empty(len(position))
+    probs.fill(floor)
+    probs[found] = t.probs[position[found]]
+    return t_table_from_events(sources, targets, probs, st_count.num_targets())
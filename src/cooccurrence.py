@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'amansour'
+
+import numpy as np
+import multiprocessing as mp
+from collections import defaultdict
+from itertools import izip
+from scipy.sparse import csr_matrix
+
+from corpus import OFFSET_DTYPE
+
+
+class CooccurrenceCounts(object):
+    # fe is a (source vocab x target vocab) CSR matrix: fe[f, e] is the number of sentences
+    # in which f and e co-occur. Rows and column indices are sorted, so the stored entries
+    # enumerate the events in (f, e) order.
+    # s_count[f] is the number of sentences containing f, d_count[e] the number of tokens of e.
+    def __init__(self, fe, s_count, d_count):
+        self.fe = fe
+        self.s_count = s_count
+        self.d_count = d_count
+        self._event_keys = None
+
+    def __len__(self):
+        return self.fe.nnz
+
+    def event_sources(self):
+        return np.repeat(np.arange(self.fe.shape[0], dtype=np.int32), np.diff(self.fe.indptr))
+
+    def event_targets(self):
+        return self.fe.indices
+
+    def events(self):
+        return zip(self.event_sources().tolist(), self.fe.indices.tolist())
+
+    def to_dict(self):
+        return dict(zip(self.events(), self.fe.data.tolist()))
+
+    def source_count_dict(self):
+        nonzero = np.flatnonzero(self.s_count)
+        return defaultdict(int, zip(nonzero.tolist(), self.s_count[nonzero].tolist()))
+
+    def target_count_dict(self):
+        nonzero = np.flatnonzero(self.d_count)
+        return defaultdict(int, zip(nonzero.tolist(), self.d_count[nonzero].tolist()))
+
+    def event_keys(self):
+        # f*|V_e|+e of every event, increasing with the event id
+        if self._event_keys is None:
+            self._event_keys = self.event_sources() * np.int64(self.fe.shape[1]) + self.fe.indices
+        return self._event_keys
+
+    def pair_ids(self, sources, targets):
+        # Event ids of the given (f, e) pairs, -1 for pairs that never co-occur
+        keys = np.asarray(sources, dtype=np.int64) * self.fe.shape[1] + np.asarray(targets)
+        event_keys = self.event_keys()
+        if len(event_keys) == 0:
+            return np.full(keys.shape, -1, dtype=np.int64)
+        ids = np.minimum(np.searchsorted(event_keys, keys), len(event_keys) - 1)
+        return np.where(event_keys[ids] == keys, ids, -1)
+
+    def view(self, reverse=False):
+        return PairCountView(self, reverse)
+
+    def decision_map(self):
+        # For every target word, the source words it co-occurs with (the normalizing decisions)
+        fe = self.fe.tocsc()
+        decisions = defaultdict(list)
+        indptr = fe.indptr.tolist()
+        indices = fe.indices.tolist()
+        for e in np.flatnonzero(np.diff(fe.indptr)).tolist():
+            decisions[e] = indices[indptr[e]:indptr[e+1]]
+        return decisions
+
+
+class PairCountView(object):
+    # A read-only mapping over one CooccurrenceCounts, keyed by (f, e) or, when reversed,
+    # by (e, f). Both directions enumerate the same events in the same order, so event
+    # ids are shared and nothing is copied. Missing pairs count 0 like a defaultdict(int).
+    def __init__(self, counts, reverse=False):
+        self.counts = counts
+        self.reverse = reverse
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        return izip(self.event_sources().tolist(), self.event_targets().tolist())
+
+    def __getitem__(self, pair):
+        (s, d) = pair
+        if self.reverse:
+            (s, d) = (d, s)
+        if not 0 <= s < self.counts.fe.shape[0] or not 0 <= d < self.counts.fe.shape[1]:
+            return 0
+        fe = self.counts.fe
+        (start, end) = (fe.indptr[s], fe.indptr[s+1])
+        k = start + np.searchsorted(fe.indices[start:end], d)
+        if k < end and fe.indices[k] == d:
+            return fe.data[k]
+        return 0
+
+    def __contains__(self, pair):
+        return self[pair] != 0
+
+    def pair_ids(self, sources, targets):
+        if self.reverse:
+            return self.counts.pair_ids(targets, sources)
+        return self.counts.pair_ids(sources, targets)
+
+    def event_keys(self):
+        return self.counts.event_keys()
+
+    def num_targets(self):
+        return self.counts.fe.shape[0 if self.reverse else 1]
+
+    def event_sources(self):
+        return self.counts.event_targets() if self.reverse else self.counts.event_sources()
+
+    def event_targets(self):
+        return self.counts.event_sources() if self.reverse else self.counts.event_targets()
+
+    def keys(self):
+        return list(iter(self))
+
+    def iteritems(self):
+        return izip(iter(self), self.counts.fe.data.tolist())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def source_counts(self):
+        return self.counts.target_count_dict() if self.reverse else self.counts.source_count_dict()
+
+
+def sentence_cooccurrences(source_tokens, source_offsets, target_tokens, target_offsets, target_vocab_size):
+    # Returns, for a block of sentences, the (sentence, f) pairs of distinct source words and
+    # the key f*|V_e|+e of every distinct source/target word pair of every sentence.
+    # Offsets are relative to the start of the given token arrays.
+    source_sentence = np.repeat(np.arange(len(source_offsets) - 1), np.diff(source_offsets))
+    target_sentence = np.repeat(np.arange(len(target_offsets) - 1), np.diff(target_offsets))
+
+    # Distinct words per sentence, ordered by sentence
+    num_sources = source_tokens.max() + 1 if len(source_tokens) else 1
+    source_set = np.unique(source_sentence * np.int64(num_sources) + source_tokens)
+    (source_set_sentence, source_set_word) = np.divmod(source_set, num_sources)
+    target_set = np.unique(target_sentence * np.int64(target_vocab_size) + target_tokens)
+    (target_set_sentence, target_set_word) = np.divmod(target_set, target_vocab_size)
+
+    # Cartesian product set(f) x set(e) inside every sentence
+    num_sentences = len(source_offsets) - 1
+    targets_per_sentence = np.bincount(target_set_sentence, minlength=num_sentences)
+    target_start = np.concatenate(([0], np.cumsum(targets_per_sentence)[:-1]))
+    repeats = targets_per_sentence[source_set_sentence]
+    pair_source = np.repeat(source_set_word, repeats)
+    block_start = np.repeat(np.cumsum(repeats) - repeats, repeats)
+    pair_target_position = np.arange(len(pair_source)) - block_start + np.repeat(target_start[source_set_sentence], repeats)
+    pair_target = target_set_word[pair_target_position]
+
+    return (source_set_word, pair_source * np.int64(target_vocab_size) + pair_target)
+
+
+def count_shard(shard):
+    (source_tokens, source_offsets, target_tokens, target_offsets, target_vocab_size) = shard
+    (source_words, keys) = sentence_cooccurrences(source_tokens, source_offsets, target_tokens, target_offsets, target_vocab_size)
+    (keys, counts) = np.unique(keys, return_counts=True)
+    return (source_words, keys, counts)
+
+
+def shard_corpus(corpus, num_shards):
+    # Contiguous sentence ranges with token arrays copied out and offsets rebased,
+    # so that only the shard itself is sent to a worker
+    bounds = np.linspace(0, len(corpus), num_shards + 1).astype(int)
+    shards = []
+    for k in range(num_shards):
+        (start, end) = (bounds[k], bounds[k+1])
+        if start == end:
+            continue
+        source_offsets = corpus.source_offsets[start:end+1]
+        target_offsets = corpus.target_offsets[start:end+1]
+        shards.append((corpus.source_tokens[source_offsets[0]:source_offsets[-1]].copy(),
+                       (source_offsets - source_offsets[0]).astype(OFFSET_DTYPE),
+                       corpus.target_tokens[target_offsets[0]:target_offsets[-1]].copy(),
+                       (target_offsets - target_offsets[0]).astype(OFFSET_DTYPE),
+                       len(corpus.target_vocab)))
+    return shards
+
+
+def count_cooccurrences(corpus, processes=None, shards_per_process=4):
+    if processes is None:
+        processes = mp.cpu_count()
+    num_sources = len(corpus.source_vocab)
+    num_targets = len(corpus.target_vocab)
+
+    shards = shard_corpus(corpus, max(1, processes * shards_per_process))
+    if processes > 1 and len(shards) > 1:
+        pool = mp.Pool(processes)
+        results = pool.map(count_shard, shards)
+        pool.close()
+        pool.join()
+    else:
+        results = [count_shard(shard) for shard in shards]
+
+    # Merge the per-shard COO blocks
+    s_count = np.zeros(num_sources, dtype=np.int64)
+    all_keys = []
+    all_counts = []
+    for (source_words, keys, counts) in results:
+        s_count += np.bincount(source_words, minlength=num_sources)
+        all_keys.append(keys)
+        all_counts.append(counts)
+    if all_keys:
+        (keys, inverse) = np.unique(np.concatenate(all_keys), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate(all_counts)).astype(np.int64)
+    else:
+        keys = np.zeros(0, dtype=np.int64)
+        counts = np.zeros(0, dtype=np.int64)
+    (rows, cols) = np.divmod(keys, num_targets)
+    fe = csr_matrix((counts, (rows, cols)), shape=(num_sources, num_targets))
+    fe.sort_indices()
+
+    target_tokens = corpus.target_tokens[corpus.target_offsets[0]:corpus.target_offsets[-1]]
+    d_count = np.bincount(target_tokens, minlength=num_targets).astype(np.int64)
+    return CooccurrenceCounts(fe, s_count, d_count)
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'amansour'
+
+import bz2
+import gzip
+from array import array
+from collections import defaultdict
+from itertools import islice, izip, izip_longest
+import numpy as np
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Word ids are int32, sentence boundaries are kept as int64 offsets into one flat
+# token array per side (CSR-style): sentence n is tokens[offsets[n]:offsets[n+1]]
+TOKEN_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+
+
+class Vocabulary(object):
+    def __init__(self, words=None):
+        self.index = {}
+        self.words = []
+        if words is not None:
+            for word in words:
+                self.intern(word)
+
+    def intern(self, word):
+        word_id = self.index.get(word)
+        if word_id is None:
+            word_id = len(self.words)
+            self.index[word] = word_id
+            self.words.append(word)
+        return word_id
+
+    def intern_sentence(self, sentence):
+        return [self.intern(word) for word in sentence]
+
+    def decode(self, ids):
+        return [self.words[i] for i in ids]
+
+    def __getitem__(self, word_id):
+        return self.words[word_id]
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __len__(self):
+        return len(self.words)
+
+
+class Corpus(object):
+    # A sentence-aligned bitext over interned ids. Iterating yields (S, D) pairs of
+    # int32 views, so code written against lists of token lists keeps working.
+    def __init__(self, source_tokens, source_offsets, target_tokens, target_offsets, source_vocab, target_vocab):
+        self.source_tokens = source_tokens
+        self.source_offsets = source_offsets
+        self.target_tokens = target_tokens
+        self.target_offsets = target_offsets
+        self.source_vocab = source_vocab
+        self.target_vocab = target_vocab
+
+    def __len__(self):
+        return len(self.source_offsets) - 1
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            (start, stop, step) = n.indices(len(self))
+            if step != 1:
+                raise ValueError("Corpus slices must be contiguous")
+            stop = max(start, stop)
+            # Offsets are absolute, so a slice is a view over the same token arrays
+            return Corpus(self.source_tokens, self.source_offsets[start:stop+1],
+                          self.target_tokens, self.target_offsets[start:stop+1],
+                          self.source_vocab, self.target_vocab)
+        if n < 0:
+            n += len(self)
+        if n < 0 or n >= len(self):
+            raise IndexError("sentence index out of range")
+        S = self.source_tokens[self.source_offsets[n]:self.source_offsets[n+1]]
+        D = self.target_tokens[self.target_offsets[n]:self.target_offsets[n+1]]
+        return (S, D)
+
+    def __iter__(self):
+        source_tokens = self.source_tokens
+        target_tokens = self.target_tokens
+        source_offsets = self.source_offsets.tolist()
+        target_offsets = self.target_offsets.tolist()
+        for n in range(len(source_offsets) - 1):
+            yield (source_tokens[source_offsets[n]:source_offsets[n+1]],
+                   target_tokens[target_offsets[n]:target_offsets[n+1]])
+
+    def source_lengths(self):
+        return np.diff(self.source_offsets)
+
+    def target_lengths(self):
+        return np.diff(self.target_offsets)
+
+    def reverse(self):
+        # The other alignment direction, sharing the same token arrays
+        return Corpus(self.target_tokens, self.target_offsets, self.source_tokens, self.source_offsets,
+                      self.target_vocab, self.source_vocab)
+
+    def stack(self, indices):
+        # Token ids of sentences that all have the same lengths as two 2D arrays, (B, T) and (B, N)
+        indices = np.asarray(indices)
+        source_starts = self.source_offsets[indices]
+        target_starts = self.target_offsets[indices]
+        T = self.source_offsets[indices[0]+1] - source_starts[0]
+        N = self.target_offsets[indices[0]+1] - target_starts[0]
+        S = self.source_tokens[source_starts[:, None] + np.arange(T)]
+        D = self.target_tokens[target_starts[:, None] + np.arange(N)]
+        return (S, D)
+
+    def words(self, n):
+        (S, D) = self[n]
+        return (self.source_vocab.decode(S), self.target_vocab.decode(D))
+
+
+def intern_bitext(pairs, source_vocab=None, target_vocab=None):
+    # pairs is any iterable of (source words, target words)
+    if source_vocab is None:
+        source_vocab = Vocabulary()
+    if target_vocab is None:
+        target_vocab = Vocabulary()
+    source_tokens = array('i')
+    target_tokens = array('i')
+    source_offsets = array('l', [0])
+    target_offsets = array('l', [0])
+    for (S, D) in pairs:
+        source_tokens.extend(source_vocab.intern_sentence(S))
+        target_tokens.extend(target_vocab.intern_sentence(D))
+        source_offsets.append(len(source_tokens))
+        target_offsets.append(len(target_tokens))
+    return Corpus(np.array(source_tokens, dtype=TOKEN_DTYPE), np.array(source_offsets, dtype=OFFSET_DTYPE),
+                  np.array(target_tokens, dtype=TOKEN_DTYPE), np.array(target_offsets, dtype=OFFSET_DTYPE),
+                  source_vocab, target_vocab)
+
+
+def length_buckets(corpus):
+    # Groups sentence pairs by (target length N, source length T). Returns a list of
+    # (N, T, indices) sorted by shape, where indices keep the original order inside a bucket.
+    N = corpus.target_lengths()
+    T = corpus.source_lengths()
+    keys = N * (T.max() + 1 if len(T) else 1) + T
+    order = np.argsort(keys, kind='mergesort')
+    (_, starts) = np.unique(keys[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    buckets = []
+    for (start, end) in zip(starts.tolist(), ends.tolist()):
+        n = order[start]
+        buckets.append((int(N[n]), int(T[n]), order[start:end]))
+    return buckets
+
+
+LENGTH_POLICIES = ['drop', 'truncate', 'split']
+
+
+def gather_segments(tokens, starts, ends):
+    # Concatenates tokens[starts[k]:ends[k]] for every k into one token array with offsets
+    lengths = ends - starts
+    offsets = np.zeros(len(lengths) + 1, dtype=OFFSET_DTYPE)
+    np.cumsum(lengths, out=offsets[1:])
+    positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - starts, lengths)
+    return (tokens[positions], offsets)
+
+
+def apply_length_policy(corpus, max_length, policy='drop'):
+    # Bounds both sides of every pair by max_length tokens, which bounds the HMM tables:
+    #   drop     - pairs with a side over max_length are removed
+    #   truncate - both sides are cut to their first max_length tokens
+    #   split    - the pair is cut into k consecutive pieces on both sides, with k the
+    #              smallest number of pieces that brings the longer side within max_length;
+    #              pieces of a split pair left empty on one side are dropped
+    # Returns the new corpus, origin[k] = index of the input pair that pair k came from,
+    # and statistics about what was affected.
+    if policy not in LENGTH_POLICIES:
+        raise ValueError("unknown length policy %r, expected one of %s" % (policy, ", ".join(LENGTH_POLICIES)))
+    source_starts = corpus.source_offsets[:-1]
+    source_lengths = corpus.source_lengths()
+    target_starts = corpus.target_offsets[:-1]
+    target_lengths = corpus.target_lengths()
+
+    stats = defaultdict(int)
+    stats['pairs'] = len(corpus)
+    stats['max_source_length'] = int(source_lengths.max()) if len(corpus) else 0
+    stats['max_target_length'] = int(target_lengths.max()) if len(corpus) else 0
+    over = np.flatnonzero((source_lengths > max_length) | (target_lengths > max_length))
+    stats['over_length'] = len(over)
+
+    if policy == 'drop':
+        origin = np.setdiff1d(np.arange(len(corpus)), over)
+        segments = (source_starts[origin], source_starts[origin] + source_lengths[origin],
+                    target_starts[origin], target_starts[origin] + target_lengths[origin])
+        stats['dropped'] = len(over)
+    elif policy == 'truncate':
+        origin = np.arange(len(corpus))
+        segments = (source_starts, source_starts + np.minimum(source_lengths, max_length),
+                    target_starts, target_starts + np.minimum(target_lengths, max_length))
+        stats['truncated'] = len(over)
+    else:
+        pieces = np.ones(len(corpus), dtype=np.int64)
+        longer = np.maximum(source_lengths[over], target_lengths[over])
+        pieces[over] = (longer + max_length - 1) // max_length
+        origin = np.repeat(np.arange(len(corpus)), pieces)
+        # Piece p of k covers [p*len/k, (p+1)*len/k) of each side
+        piece = np.arange(len(origin)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        k = pieces[origin]
+        segments = (source_starts[origin] + piece * source_lengths[origin] // k,
+                    source_starts[origin] + (piece + 1) * source_lengths[origin] // k,
+                    target_starts[origin] + piece * target_lengths[origin] // k,
+                    target_starts[origin] + (piece + 1) * target_lengths[origin] // k)
+        # A much shorter side can leave pieces of a split pair with nothing on it, those are
+        # not usable pairs; pairs that were not split are kept as they are, like with drop
+        kept = np.flatnonzero((k == 1) | ((segments[1] > segments[0]) & (segments[3] > segments[2])))
+        stats['empty_pieces'] = len(origin) - len(kept)
+        origin = origin[kept]
+        segments = tuple(bound[kept] for bound in segments)
+        stats['split'] = len(over)
+        stats['pieces'] = int(pieces[over].sum())
+
+    (source_tokens, source_offsets) = gather_segments(corpus.source_tokens, segments[0], segments[1])
+    (target_tokens, target_offsets) = gather_segments(corpus.target_tokens, segments[2], segments[3])
+    bounded = Corpus(source_tokens, source_offsets, target_tokens, target_offsets,
+                     corpus.source_vocab, corpus.target_vocab)
+    stats['source_tokens_removed'] = int(source_lengths.sum() - len(source_tokens))
+    stats['target_tokens_removed'] = int(target_lengths.sum() - len(target_tokens))
+    return (bounded, origin, stats)
+
+
+def word_suffix(word, length=3):
+    # The last length characters, not bytes, of a UTF-8 word (bytes that are not UTF-8 are
+    # replaced), so a multi-byte character is never cut in half
+    suffix = word.decode('utf-8', 'replace')[-length:].lower()
+    return "<rare-suffix:%s>" % suffix.encode('utf-8')
+
+
+def word_shape(word):
+    # Capitals become X, lower case letters x and digits d, runs of the same class collapse
+    shape = []
+    for ch in word:
+        if ch.isupper():
+            ch = 'X'
+        elif ch.isalpha():
+            ch = 'x'
+        elif ch.isdigit():
+            ch = 'd'
+        if not shape or shape[-1] != ch:
+            shape.append(ch)
+    return "<rare-shape:%s>" % "".join(shape)
+
+
+RARE_WORD_CLASSES = {'suffix': word_suffix, 'shape': word_shape}
+
+
+class RareWordBuckets(object):
+    # Maps the ids of original_vocab to a smaller vocabulary where every word seen fewer
+    # than min_count times is replaced by its class token. Token positions never change,
+    # so alignments computed on the bucketed ids hold for the original sentences.
+    def __init__(self, original_vocab, frequencies, min_count, word_class='suffix'):
+        self.original_vocab = original_vocab
+        self.min_count = min_count
+        self.word_class = word_class
+        self.vocab = Vocabulary()
+        self.mapping = np.zeros(0, dtype=TOKEN_DTYPE)
+        self.extend(frequencies)
+
+    def extend(self, frequencies=None):
+        # Words interned into original_vocab after the buckets were built were never
+        # seen in training and go to their class
+        classify = RARE_WORD_CLASSES[self.word_class]
+        start = len(self.mapping)
+        mapping = np.empty(len(self.original_vocab) - start, dtype=TOKEN_DTYPE)
+        for (k, word) in enumerate(self.original_vocab.words[start:]):
+            if frequencies is not None and frequencies[start + k] >= self.min_count:
+                mapping[k] = self.vocab.intern(word)
+            else:
+                mapping[k] = self.vocab.intern(classify(word))
+        self.mapping = np.concatenate((self.mapping, mapping))
+
+    def map_tokens(self, tokens):
+        if len(self.mapping) < len(self.original_vocab):
+            self.extend()
+        return self.mapping[tokens]
+
+    def rare_words(self):
+        # Number of original words that were replaced by a class
+        is_class = np.array([word.startswith("<rare-") for word in self.vocab.words], dtype=bool)
+        return int(is_class[self.mapping].sum())
+
+
+def bucket_rare_words(corpus, min_count, word_class='suffix'):
+    # Returns the corpus over the bucketed vocabularies and the buckets of both sides
+    source_tokens = corpus.source_tokens[corpus.source_offsets[0]:corpus.source_offsets[-1]]
+    target_tokens = corpus.target_tokens[corpus.target_offsets[0]:corpus.target_offsets[-1]]
+    source_buckets = RareWordBuckets(corpus.source_vocab, np.bincount(source_tokens, minlength=len(corpus.source_vocab)), min_count, word_class)
+    target_buckets = RareWordBuckets(corpus.target_vocab, np.bincount(target_tokens, minlength=len(corpus.target_vocab)), min_count, word_class)
+    return (apply_rare_word_buckets(corpus, source_buckets, target_buckets), source_buckets, target_buckets)
+
+
+def apply_rare_word_buckets(corpus, source_buckets, target_buckets):
+    # corpus must be interned with the original vocabularies of the buckets
+    return Corpus(source_buckets.map_tokens(corpus.source_tokens), corpus.source_offsets,
+                  target_buckets.map_tokens(corpus.target_tokens), corpus.target_offsets,
+                  source_buckets.vocab, target_buckets.vocab)
+
+
+def open_text(file_name):
+    # Compressed inputs are decompressed on the fly, chosen by the file extension
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rb')
+    if file_name.endswith('.bz2'):
+        return bz2.BZ2File(file_name, 'rb')
+    if file_name.endswith('.xz'):
+        if lzma is None:
+            raise IOError("reading %s needs the lzma module (pip install backports.lzma)" % file_name)
+        return lzma.open(file_name, 'rb')
+    return open(file_name)
+
+
+def read_bitext(source_file, target_file, num_sents=None):
+    # Lazily yields tokenized (source, target) pairs and stops after num_sents lines,
+    # so nothing past what is used is ever read
+    with open_text(source_file) as source, open_text(target_file) as target:
+        for (s, d) in islice(izip(source, target), num_sents):
+            yield (s.strip().split(), d.strip().split())
+
+
+def read_parallel_lines(file_name, num_sents=None, separator=' ||| '):
+    # Raw (source, target) lines of a single-file 'source ||| target' bitext
+    with open_text(file_name) as parallel:
+        for (n, line) in enumerate(islice(parallel, num_sents)):
+            sides = line.rstrip('\r\n').split(separator, 1)
+            if len(sides) != 2:
+                raise ValueError("%s line %d is not in 'source%starget' format" % (file_name, n + 1, separator))
+            yield (sides[0], sides[1])
+
+
+def read_parallel_file(file_name, num_sents=None, separator=' ||| '):
+    for (s, d) in read_parallel_lines(file_name, num_sents, separator):
+        yield (s.split(), d.split())
+
+
+def load_bitext(source_file, target_file, num_sents=None, source_vocab=None, target_vocab=None):
+    return intern_bitext(read_bitext(source_file, target_file, num_sents), source_vocab, target_vocab)
+
+
+def load_parallel_file(file_name, num_sents=None, source_vocab=None, target_vocab=None, separator=' ||| '):
+    return intern_bitext(read_parallel_file(file_name, num_sents, separator), source_vocab, target_vocab)
+
+
+class MultilingualCorpus(object):
+    # Several languages sentence-aligned against one pivot language. The pivot side is
+    # interned and stored once; every language pair is a Corpus whose target side is the
+    # shared pivot token array and vocabulary.
+    def __init__(self, pivot_tokens, pivot_offsets, pivot_vocab):
+        self.pivot_tokens = pivot_tokens
+        self.pivot_offsets = pivot_offsets
+        self.pivot_vocab = pivot_vocab
+        self.languages = []
+        self.foreign = {}
+
+    def add_language(self, language, tokens, offsets, vocab):
+        if len(offsets) != len(self.pivot_offsets):
+            raise ValueError("%s has %d sentences, the pivot has %d" % (language, len(offsets) - 1, len(self.pivot_offsets) - 1))
+        self.languages.append(language)
+        self.foreign[language] = (tokens, offsets, vocab)
+
+    def pair(self, language):
+        (tokens, offsets, vocab) = self.foreign[language]
+        return Corpus(tokens, offsets, self.pivot_tokens, self.pivot_offsets, vocab, self.pivot_vocab)
+
+    def __len__(self):
+        return len(self.pivot_offsets) - 1
+
+
+def load_multilingual(pivot_file, foreign_files, num_sents=None, pivot_vocab=None):
+    # foreign_files is a list of (language, file name), all line-aligned with pivot_file.
+    # All files are read together in one pass and the pivot is tokenized only once. Files
+    # that end before the others (within num_sents lines) raise ValueError.
+    if pivot_vocab is None:
+        pivot_vocab = Vocabulary()
+    languages = [language for (language, _) in foreign_files]
+    vocabs = [Vocabulary() for _ in foreign_files]
+    tokens = [array('i') for _ in foreign_files]
+    offsets = [array('l', [0]) for _ in foreign_files]
+    pivot_tokens = array('i')
+    pivot_offsets = array('l', [0])
+    files = [open_text(pivot_file)] + [open_text(file_name) for (_, file_name) in foreign_files]
+    try:
+        for (n, lines) in enumerate(islice(izip_longest(*files), num_sents)):
+            if None in lines:
+                names = [pivot_file] + [file_name for (_, file_name) in foreign_files]
+                ended = [name for (name, line) in zip(names, lines) if line is None]
+                raise ValueError("%s ended after %d sentences, before the other files" % (', '.join(ended), n))
+            pivot_tokens.extend(pivot_vocab.intern_sentence(lines[0].strip().split()))
+            pivot_offsets.append(len(pivot_tokens))
+            for (k, line) in enumerate(lines[1:]):
+                tokens[k].extend(vocabs[k].intern_sentence(line.strip().split()))
+                offsets[k].append(len(tokens[k]))
+    finally:
+        for f in files:
+            f.close()
+    corpora = MultilingualCorpus(np.array(pivot_tokens, dtype=TOKEN_DTYPE), np.array(pivot_offsets, dtype=OFFSET_DTYPE), pivot_vocab)
+    for k in range(len(languages)):
+        corpora.add_language(languages[k], np.array(tokens[k], dtype=TOKEN_DTYPE), np.array(offsets[k], dtype=OFFSET_DTYPE), vocabs[k])
+    return corpora
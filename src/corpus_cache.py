@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'amansour'
+
+import os
+import shutil
+import hashlib
+import pickle
+import tempfile
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from corpus import Corpus, Vocabulary
+from cooccurrence import CooccurrenceCounts
+
+# Bump whenever the layout of a cache entry or the meaning of a stored array changes
+CACHE_VERSION = 3
+
+CORPUS_ARRAYS = ['source_tokens', 'source_offsets', 'target_tokens', 'target_offsets']
+
+
+def file_digest(file_name, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            digest.update(block)
+            block = f.read(block_size)
+    return digest.hexdigest()
+
+
+def cache_key(file_names, num_sents, settings=()):
+    # settings holds any other option that changes what is stored, e.g. the length policy
+    key = hashlib.sha1()
+    key.update("version=%d\n" % CACHE_VERSION)
+    key.update("num_sents=%d\n" % num_sents)
+    key.update("settings=%r\n" % (tuple(settings),))
+    for file_name in file_names:
+        key.update("%s\n" % file_digest(file_name))
+    return key.hexdigest()
+
+
+def save_cache(cache_dir, key, corpus, counts, extras=None):
+    # Every array is its own .npy file so that loading can memory-map it.
+    # The entry is written to a temporary directory first and renamed into place.
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return entry
+    tmp = tempfile.mkdtemp(dir=cache_dir)
+    for name in CORPUS_ARRAYS:
+        np.save(os.path.join(tmp, name + '.npy'), getattr(corpus, name))
+    np.save(os.path.join(tmp, 'fe_data.npy'), counts.fe.data)
+    np.save(os.path.join(tmp, 'fe_indices.npy'), counts.fe.indices)
+    np.save(os.path.join(tmp, 'fe_indptr.npy'), counts.fe.indptr)
+    np.save(os.path.join(tmp, 's_count.npy'), counts.s_count)
+    np.save(os.path.join(tmp, 'd_count.npy'), counts.d_count)
+    meta = {'version': CACHE_VERSION,
+            'source_words': corpus.source_vocab.words,
+            'target_words': corpus.target_vocab.words,
+            'fe_shape': counts.fe.shape,
+            'extras': extras}
+    with open(os.path.join(tmp, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # Another run stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+    return entry
+
+
+def load_cache(cache_dir, key, mmap_mode='r'):
+    # Returns (corpus, counts, extras), or None when there is no usable entry
+    entry = os.path.join(cache_dir, key)
+    meta_file = os.path.join(entry, 'meta.pkl')
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file, 'rb') as f:
+        meta = pickle.load(f)
+    if meta.get('version') != CACHE_VERSION:
+        return None
+
+    def load(name):
+        return np.load(os.path.join(entry, name + '.npy'), mmap_mode=mmap_mode)
+
+    corpus = Corpus(load('source_tokens'), load('source_offsets'),
+                    load('target_tokens'), load('target_offsets'),
+                    Vocabulary(meta['source_words']), Vocabulary(meta['target_words']))
+    fe = csr_matrix((load('fe_data'), load('fe_indices'), load('fe_indptr')), shape=meta['fe_shape'])
+    counts = CooccurrenceCounts(fe, load('s_count'), load('d_count'))
+    return (corpus, counts, meta['extras'])
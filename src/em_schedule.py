@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'amansour'
+
+import sys
+import time
+import math
+
+# Probability given to word pairs never seen in training when a held-out corpus is scored
+HELDOUT_FLOOR = 1e-7
+
+
+class EMSchedule(object):
+    # Decides how many EM iterations a training stage runs. An EM loop iterates over the
+    # schedule and reports every finished iteration with end_iteration():
+    #
+    #   for iterations in schedule:
+    #       ...E step and M step...
+    #       schedule.end_iteration(logLikelihood)
+    #
+    # The stage stops after max_iterations, or as soon as the relative change of the
+    # log-likelihood falls below tolerance, or, when a held-out corpus is given, as soon as
+    # the held-out perplexity stops improving. tolerance=0 never stops early.
+    #
+    # With a held-out corpus, best_iteration is the iteration with the lowest held-out
+    # perplexity so far. EM loops keep the parameters of every iteration for which improved()
+    # is true and return those, not the ones of the iteration that made the perplexity worse:
+    #
+    #       schedule.end_iteration(logLikelihood, heldout_log_likelihood, heldout_tokens)
+    #       if schedule.improved():
+    #           best = parameters
+    def __init__(self, name, max_iterations=10, tolerance=0.0, heldout=None, log=sys.stderr):
+        self.name = name
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.heldout = heldout
+        self.log = log
+        self.history = []
+        self.stop_reason = None
+        self.best_iteration = None
+
+    def __iter__(self):
+        self.history = []
+        self.stop_reason = None
+        self.best_iteration = None
+        for iteration in range(self.max_iterations):
+            self.start_time = time.time()
+            yield iteration
+            if self.stop_reason is not None:
+                return
+        self.stop_reason = "reached %d iterations" % self.max_iterations
+
+    def end_iteration(self, log_likelihood, heldout_log_likelihood=None, heldout_tokens=None):
+        seconds = time.time() - self.start_time
+        heldout_perplexity = None
+        if heldout_log_likelihood is not None and heldout_tokens:
+            heldout_perplexity = math.exp(-heldout_log_likelihood/heldout_tokens)
+        iteration = len(self.history)
+        message = "%s iteration %d: log-likelihood %f" % (self.name, iteration, log_likelihood)
+        if self.history:
+            last = self.history[-1]
+            change = abs(log_likelihood - last['log_likelihood'])/max(abs(last['log_likelihood']), 1e-300)
+            message += " (relative change %.2e)" % change
+            if change < self.tolerance:
+                self.stop_reason = "relative change %.2e below tolerance %.2e" % (change, self.tolerance)
+            if heldout_perplexity is not None and last['heldout_perplexity'] is not None and heldout_perplexity >= last['heldout_perplexity']:
+                self.stop_reason = "held-out perplexity went from %f to %f" % (last['heldout_perplexity'], heldout_perplexity)
+        if heldout_perplexity is not None:
+            message += ", held-out perplexity %f" % heldout_perplexity
+            if self.best_iteration is None or heldout_perplexity < self.history[self.best_iteration]['heldout_perplexity']:
+                self.best_iteration = iteration
+        message += ", %.2fs\n" % seconds
+        self.history.append({'log_likelihood': log_likelihood, 'heldout_perplexity': heldout_perplexity, 'seconds': seconds})
+        if self.log is not None:
+            self.log.write(message)
+            if self.stop_reason is not None:
+                self.log.write("%s stopped after %d iterations: %s\n" % (self.name, iteration + 1, self.stop_reason))
+                if self.best_iteration is not None and self.best_iteration != iteration:
+                    self.log.write("%s keeps the parameters of iteration %d\n" % (self.name, self.best_iteration))
+
+    def improved(self):
+        # True when the iteration just reported has the lowest held-out perplexity so far
+        return self.best_iteration is not None and self.best_iteration == len(self.history) - 1
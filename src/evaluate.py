@@ -4,10 +4,17 @@
 __author__ = 'amansour'
 
 import sys
+from itertools import izip
+from corpus import open_text, read_parallel_lines
 
+#When e_data is None, f_data is a single 'f ||| e' parallel file
 def grade_align(f_data, e_data, reference, system, output):
     (size_a, size_s, size_a_and_s, size_a_and_p) = (0.0,0.0,0.0,0.0)
-    for (n, (f, e, g, a)) in enumerate(zip(open(f_data), open(e_data), open(reference), open(system))):
+    if e_data is None:
+        sentence_pairs = read_parallel_lines(f_data)
+    else:
+        sentence_pairs = izip(open_text(f_data), open_text(e_data))
+    for (n, ((f, e), g, a)) in enumerate(izip(sentence_pairs, open(reference), open(system))):
       print n
       fwords = f.strip().split()
       ewords = e.strip().split()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'amansour'
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from collections import defaultdict
+
+# Scaled forward-backward (Rabiner, 1989) shared by the HMM variants. Arrays keep the
+# 1-based layout of the variants: alpha_hat[i,t] and beta_hat[i,t] for states i=1..N and
+# source positions t=1..T, with row and column 0 unused. Every time step is one
+# matrix-vector product with the N x N transition matrix A[i-1,j-1] = p(j|i) and the
+# emission row emission[t-1,j-1] = t(y_t|d_j) of the step's source word.
+
+
+def emission_matrix(t_table, y, d):
+    # T x N emissions of source sentence y from the words of target sentence d, in one
+    # batched lookup for tables that have one (SparseTTable)
+    if hasattr(t_table, 'lookup'):
+        return t_table.lookup(np.asarray(y)[:, None], np.asarray(d)[None, :]).reshape((len(y), len(d)))
+    return np.array([[t_table[(y_t, d_j)] for d_j in d] for y_t in y], dtype=np.float64).reshape((len(y), len(d)))
+
+
+def forward_scaled(A, pi, emission):
+    # pi[i-1] is the start probability of state i
+    (T, N) = emission.shape
+    c_scaled = np.ones(T+1)
+    alpha_hat = np.zeros((N+1, T+1))
+    alpha = np.asarray(pi, dtype=np.float64)*emission[0]
+    c_scaled[1] = 1.0/alpha.sum()
+    alpha_hat[1:, 1] = c_scaled[1]*alpha
+    for t in range(1, T):
+        alpha = alpha_hat[1:, t].dot(A)*emission[t]
+        c_scaled[t+1] = 1.0/alpha.sum()
+        alpha_hat[1:, t+1] = c_scaled[t+1]*alpha
+    return (alpha_hat, c_scaled)
+
+
+def backward_scaled(A, emission, c_scaled):
+    (T, N) = emission.shape
+    beta_hat = np.zeros((N+1, T+1))
+    beta_hat[1:, T] = c_scaled[T]
+    for t in range(T-1, 0, -1):
+        beta_hat[1:, t] = c_scaled[t]*A.dot(beta_hat[1:, t+1]*emission[t])
+    return beta_hat
+
+
+def forward_scaled_batch(A, pi, emission):
+    # forward_scaled for B sentences of the same shape sharing one transition matrix:
+    # emission is B x T x N, alpha_hat is B x (N+1) x (T+1) and c_scaled B x (T+1)
+    (B, T, N) = emission.shape
+    c_scaled = np.ones((B, T+1))
+    alpha_hat = np.zeros((B, N+1, T+1))
+    alpha = np.asarray(pi, dtype=np.float64)*emission[:, 0, :]
+    c_scaled[:, 1] = 1.0/alpha.sum(axis=1)
+    alpha_hat[:, 1:, 1] = c_scaled[:, 1, None]*alpha
+    for t in range(1, T):
+        alpha = alpha_hat[:, 1:, t].dot(A)*emission[:, t, :]
+        c_scaled[:, t+1] = 1.0/alpha.sum(axis=1)
+        alpha_hat[:, 1:, t+1] = c_scaled[:, t+1, None]*alpha
+    return (alpha_hat, c_scaled)
+
+
+def backward_scaled_batch(A, emission, c_scaled):
+    (B, T, N) = emission.shape
+    beta_hat = np.zeros((B, N+1, T+1))
+    beta_hat[:, 1:, T] = c_scaled[:, T, None]
+    for t in range(T-1, 0, -1):
+        beta_hat[:, 1:, t] = c_scaled[:, t, None]*(beta_hat[:, 1:, t+1]*emission[:, t, :]).dot(A.T)
+    return beta_hat
+
+
+def expected_transitions(alpha_hat, beta_hat, emission, A):
+    # Expected transition counts of a batch (alpha_hat and beta_hat as forward_scaled_batch
+    # and backward_scaled_batch return them): xi(i,j,t) = alpha_hat[i,t]*A[i,j]*t(y_t+1|x_j)*
+    # beta_hat[j,t+1] summed over the batch and over t as one N x N matrix, without the xi
+    # tensor
+    T = emission.shape[1]
+    return np.einsum('bit,btj->ij', alpha_hat[:, 1:, 1:T], emission[:, 1:, :]*beta_hat[:, 1:, 2:].transpose((0, 2, 1)))*A
+
+
+def jump_buckets(N, window=None):
+    # N x N matrix of the jump histogram entry of every transition i->j, bucket(j-i)+N-1
+    (i, j) = np.indices((N, N))
+    buckets = j - i
+    if window is not None:
+        buckets = np.clip(buckets, -window-1, window+1)
+    return buckets + N - 1
+
+
+def diagonal_jump_counts(xi, window=None):
+    # The jump histogram of xi (N x N): c[d+N-1] is the sum of its diagonal j-i=d, with the
+    # diagonals beyond the jump window summed into the tail buckets (see jump_bucket)
+    N = xi.shape[0]
+    return np.bincount(jump_buckets(N, window).ravel(), weights=xi.ravel(), minlength=2*N - 1)
+
+
+# Banded kernels. With jump distances beyond +-W pooled into one tail bucket on each side,
+# p(j|i) outside the band |j-i| <= W is the same for every j on one side of a row i. Each
+# step then costs O(N*W): the band is gathered along its diagonals and the tails are prefix
+# or suffix sums (maxima for Viterbi) over the states.
+
+
+def jump_bucket(d, W):
+    # The bucket of jump distance d: d itself, or beyond the window W (None for no window)
+    # the tail bucket -W-1 or W+1
+    if W is None:
+        return d
+    return max(-W-1, min(W+1, d))
+
+
+def fold_jumps(c, W):
+    # Jump counts c[d] with every |d| > W moved into the tail buckets c[-W-1] and c[W+1]
+    folded = defaultdict(int)
+    for (d, value) in c.items():
+        folded[jump_bucket(d, W)] += value
+    return folded
+
+
+def band_structure(A, W):
+    # The N x N matrix A as its band and per-row tails. Diagonals are stored skewed so that
+    # they line up with windows(x, W)[j,k] = x[j+k-W]: rowband[i,k] = A[i,i+k-W] and
+    # colband[j,k] = A[j+k-W,j], 0 outside the matrix. left[i]
+    # is A[i,j] for j < i-W and right[i] is A[i,j] for j > i+W. Exact when A is constant on
+    # each side outside the band, as for transitions estimated with a jump window W.
+    N = A.shape[0]
+    states = np.arange(N)
+    padded = np.zeros((N+1, N+1))
+    padded[:N, :N] = A
+    successors = states[:, None] + np.arange(-W, W+1)
+    successors = np.where((successors >= 0) & (successors < N), successors, N)
+    rowband = padded[states[:, None], successors]
+    predecessors = states[:, None] + np.arange(-W, W+1)
+    predecessors = np.where((predecessors >= 0) & (predecessors < N), predecessors, N)
+    colband = padded[predecessors, states[:, None]]
+    left = padded[states, np.where(states - W - 1 >= 0, states - W - 1, N)]
+    right = padded[states, np.minimum(states + W + 1, N)]
+    #Tails: prefix and suffix positions of every state, outside the band
+    return (W, rowband, colband, left, right, np.maximum(states - W, 0), np.minimum(states + W + 1, N))
+
+
+def windows(x, W, fill=0.0):
+    # Read-only B x N x (2W+1) view of the rows of x (B x N), windows[b,j,k] = x[b,j+k-W],
+    # with fill outside the row
+    (B, N) = x.shape
+    padded = np.full((B, N+2*W), fill)
+    padded[:, W:W+N] = x
+    (row, column) = padded.strides
+    return as_strided(padded, shape=(B, N, 2*W+1), strides=(row, column, column))
+
+
+def prefix_sums(x):
+    # prefix[:,m] is the sum of x[:,:m], for m = 0..N
+    prefix = np.zeros((x.shape[0], x.shape[1]+1))
+    np.cumsum(x, axis=1, out=prefix[:, 1:])
+    return prefix
+
+
+def suffix_sums(x):
+    # suffix[:,m] is the sum of x[:,m:], for m = 0..N
+    suffix = np.zeros((x.shape[0], x.shape[1]+1))
+    suffix[:, :-1] = np.cumsum(x[:, ::-1], axis=1)[:, ::-1]
+    return suffix
+
+
+def banded_vector_matrix(x, band):
+    # x.dot(A) for a batch of rows x (B x N) and A given by band_structure
+    (W, rowband, colband, left, right, before, after) = band
+    total = np.einsum('bjk,jk->bj', windows(x, W), colband)
+    #Predecessors i > j+W reach j with left[i], predecessors i < j-W with right[i]
+    return total + suffix_sums(x*left)[:, after] + prefix_sums(x*right)[:, before]
+
+
+def banded_matrix_vector(x, band):
+    # A.dot(x) for a batch of columns x (B x N) and A given by band_structure
+    (W, rowband, colband, left, right, before, after) = band
+    total = np.einsum('bik,ik->bi', windows(x, W), rowband)
+    return total + left*prefix_sums(x)[:, before] + right*suffix_sums(x)[:, after]
+
+
+def banded_jump_counts(alpha_hat, beta_hat, emission, band):
+    # diagonal_jump_counts(expected_transitions(alpha_hat, beta_hat, emission, A), W) for A
+    # given by band_structure, in O(N*W) per word: the band diagonals are summed directly and
+    # each tail bucket from prefix or suffix sums, without the N x N matrix
+    (W, rowband, colband, left, right, before, after) = band
+    (B, T, N) = emission.shape
+    #One row per (sentence, word t) with a successor: alpha_hat at t and t(y_t+1|x_j)*beta_hat at t+1
+    alpha = alpha_hat[:, 1:, 1:T].transpose((0, 2, 1)).reshape((-1, N))
+    successors = (emission[:, 1:, :]*beta_hat[:, 1:, 2:].transpose((0, 2, 1))).reshape((-1, N))
+    c = np.zeros(2*N - 1)
+    jumps = np.arange(-W, W+1)
+    inside = np.abs(jumps) <= N-1
+    c[jumps[inside]+N-1] = (np.einsum('ri,rik->ik', alpha, windows(successors, W))*rowband).sum(axis=0)[inside]
+    if W+1 <= N-1:
+        c[N+W] = (right*(alpha*suffix_sums(successors)[:, after]).sum(axis=0)).sum()
+        c[N-2-W] = (left*(alpha*prefix_sums(successors)[:, before]).sum(axis=0)).sum()
+    return c
+
+
+def forward_scaled_banded_batch(band, pi, emission):
+    # forward_scaled_batch with the transition matrix given by band_structure
+    (B, T, N) = emission.shape
+    c_scaled = np.ones((B, T+1))
+    alpha_hat = np.zeros((B, N+1, T+1))
+    alpha = np.asarray(pi, dtype=np.float64)*emission[:, 0, :]
+    c_scaled[:, 1] = 1.0/alpha.sum(axis=1)
+    alpha_hat[:, 1:, 1] = c_scaled[:, 1, None]*alpha
+    for t in range(1, T):
+        alpha = banded_vector_matrix(alpha_hat[:, 1:, t], band)*emission[:, t, :]
+        c_scaled[:, t+1] = 1.0/alpha.sum(axis=1)
+        alpha_hat[:, 1:, t+1] = c_scaled[:, t+1, None]*alpha
+    return (alpha_hat, c_scaled)
+
+
+def backward_scaled_banded_batch(band, emission, c_scaled):
+    (B, T, N) = emission.shape
+    beta_hat = np.zeros((B, N+1, T+1))
+    beta_hat[:, 1:, T] = c_scaled[:, T, None]
+    for t in range(T-1, 0, -1):
+        beta_hat[:, 1:, t] = c_scaled[:, t, None]*banded_matrix_vector(beta_hat[:, 1:, t+1]*emission[:, t, :], band)
+    return beta_hat
+
+
+def forward_scaled_banded(band, pi, emission):
+    (alpha_hat, c_scaled) = forward_scaled_banded_batch(band, pi, emission[None])
+    return (alpha_hat[0], c_scaled[0])
+
+
+def backward_scaled_banded(band, emission, c_scaled):
+    return backward_scaled_banded_batch(band, emission[None], c_scaled[None])[0]
+
+
+def log_band(band):
+    (W, rowband, colband, left, right, before, after) = band
+    with np.errstate(divide='ignore'):
+        return (W, np.log(rowband), np.log(colband), np.log(left), np.log(right), before, after)
+
+
+def running_max(values):
+    # Prefix maxima of values and the position each one comes from
+    best = np.maximum.accumulate(values)
+    where = np.maximum.accumulate(np.where(values == best, np.arange(len(values)), 0))
+    return (best, where)
+
+
+def banded_max_plus(v, band):
+    # For every state j, the max over i of v[i] + log A[i,j] and its argmax i, with band the
+    # log_band of A
+    (W, rowband, colband, left, right, before, after) = band
+    N = len(v)
+    states = np.arange(N)
+    scores = windows(v[None], W, -np.inf)[0] + colband
+    k = scores.argmax(axis=1)
+    best = scores[states, k]
+    argbest = states + k - W
+    #Predecessors i > j+W: suffix maxima of v + log left; i < j-W: prefix maxima of v + log right
+    (suffix, suffix_at) = running_max((v + left)[::-1])
+    suffix = np.append(suffix[::-1], -np.inf)
+    suffix_at = np.append(N - 1 - suffix_at[::-1], 0)
+    (prefix, prefix_at) = running_max(v + right)
+    prefix = np.append(-np.inf, prefix)
+    prefix_at = np.append(0, prefix_at)
+    for (candidate, at) in ((suffix[after], suffix_at[after]), (prefix[before], prefix_at[before])):
+        better = candidate > best
+        best = np.where(better, candidate, best)
+        argbest = np.where(better, at, argbest)
+    return (best, argbest)
+
+
+# Pruned kernels. At every word, the states whose emission or whose share of the scaled
+# forward mass is below threshold are dropped (the most likely state is always kept) and the
+# next step only sums over the kept states. kept[t-1] marks the states kept at word t. The
+# scaling factors give the likelihood of the pruned lattice, a lower bound of the exact one,
+# and gamma = alpha_hat*beta_hat/c_scaled is 0 on dropped states.
+
+
+def keep_states(alpha, emission, threshold):
+    # The states of every row of alpha (B x N) that survive pruning
+    keep = (emission >= threshold) & (alpha >= threshold*alpha.sum(axis=1)[:, None])
+    keep[np.arange(alpha.shape[0]), alpha.argmax(axis=1)] = True
+    return keep
+
+
+def forward_scaled_pruned(A, pi, emission, threshold):
+    (T, N) = emission.shape
+    c_scaled = np.ones(T+1)
+    alpha_hat = np.zeros((N+1, T+1))
+    kept = np.zeros((T, N), dtype=bool)
+    alpha = np.asarray(pi, dtype=np.float64)*emission[0]
+    for t in range(T):
+        if t > 0:
+            states = np.flatnonzero(kept[t-1])
+            alpha = alpha_hat[states+1, t].dot(A[states])*emission[t]
+        kept[t] = keep_states(alpha[None], emission[None, t], threshold)[0]
+        alpha = np.where(kept[t], alpha, 0.0)
+        c_scaled[t+1] = 1.0/alpha.sum()
+        alpha_hat[1:, t+1] = c_scaled[t+1]*alpha
+    return (alpha_hat, c_scaled, kept)
+
+
+def backward_scaled_pruned(A, emission, c_scaled, kept):
+    (T, N) = emission.shape
+    beta_hat = np.zeros((N+1, T+1))
+    beta_hat[1:, T] = c_scaled[T]*kept[T-1]
+    for t in range(T-1, 0, -1):
+        states = np.flatnonzero(kept[t-1])
+        successors = np.flatnonzero(kept[t])
+        beta_hat[states+1, t] = c_scaled[t]*A[np.ix_(states, successors)].dot(beta_hat[successors+1, t+1]*emission[t, successors])
+    return beta_hat
@@ -16,11 +16,15 @@ import optparse
 import sys
 import os.path
 import HMM
-from IBM_Model1 import EM_IBM1
+from IBM_Model1 import EM_IBM1, EM_IBM1_vectorized, EM_IBM2_diagonal, EM_IBM1_online, EM_IBM1_bidirectional, t_table_over_events
 #from HMM import baumWelch, findBestAlignmentsForAll, findBestAlignmentsForAllWithIntersection, findBestAlignmentsForAll_AER, findBestAlignmentsForAllWithIntersection_AER, baumWelchP
 from HMM_with_length_with_array_null import baumWelch, findBestAlignmentsForAll, findBestAlignmentsForAllWithIntersection, findBestAlignmentsForAll_AER, findBestAlignmentsForAllWithIntersection_AER, baumWelchP
 from featurized_hmm_mp_e_step_parallel_theta_efficient import get_features_fired, em_with_features, get_gradient_with_counts, print_dictionary, get_likelihood_with_expected_counts
 from evaluate import grade_align, convert_giza_out_to_aer_out
+from corpus import load_bitext, load_parallel_file, load_multilingual, apply_length_policy, LENGTH_POLICIES, bucket_rare_words, apply_rare_word_buckets, RARE_WORD_CLASSES
+from cooccurrence import count_cooccurrences
+from corpus_cache import cache_key, load_cache, save_cache
+from em_schedule import EMSchedule
 import math
 import time
 from collections import defaultdict
@@ -40,12 +44,36 @@ optparser.add_option("-p", "--data", dest="train", default="data/hansards", help
 optparser.add_option("-e", "--english", dest="english", default="e", help="Suffix of English filename (default=e)")
 optparser.add_option("-f", "--french", dest="french", default="f", help="Suffix of French filename (default=f)")
 optparser.add_option("-t", "--threshold", dest="threshold", default=0.5, type="float", help="Threshold for aligning with Dice's coefficient (default=0.5)")
+optparser.add_option("-m", "--languages", dest="languages", default="", help="Comma separated suffixes of more languages aligned to English, read together with the French and English files, e.g. it,es (default=none, not cached)")
+optparser.add_option("-b", "--bitext", dest="bitext", default=None, help="Single 'french ||| english' file used instead of -p/-f/-e, may be .gz, .bz2 or .xz compressed")
 optparser.add_option("-n", "--num_sentences", dest="num_sents", default=sys.maxint, type="int", help="Number of sentences to use for training and alignment")
+optparser.add_option("-l", "--max_length", dest="max_length", default=0, type="int", help="Maximum sentence length used for training, longer pairs are handled by --length_policy (default=0, no limit)")
+optparser.add_option("--length_policy", dest="length_policy", default="drop", choices=LENGTH_POLICIES, help="What to do with pairs over --max_length: %s (default=drop)" % ", ".join(LENGTH_POLICIES))
+optparser.add_option("-r", "--rare_count", dest="rare_count", default=0, type="int", help="Words seen fewer times than this are replaced by a class token before training (default=0, off)")
+optparser.add_option("--rare_class", dest="rare_class", default="suffix", choices=sorted(RARE_WORD_CLASSES), help="Class of rare words: %s (default=suffix)" % ", ".join(sorted(RARE_WORD_CLASSES)))
+optparser.add_option("-c", "--cache", dest="cache", default=None, help="Directory for caching the preprocessed corpus and counts (default=no cache)")
+optparser.add_option("-j", "--processes", dest="processes", default=mp.cpu_count(), type="int", help="Number of processes used for counting and IBM1 (default=number of cpus)")
+optparser.add_option("--ibm1_iterations", dest="ibm1_iterations", default=10, type="int", help="Most EM iterations of IBM1, or of IBM2 with --warm_start ibm2 (default=10)")
+optparser.add_option("--hmm_iterations", dest="hmm_iterations", default=10, type="int", help="Most EM iterations of the HMM (default=10)")
+optparser.add_option("--tolerance", dest="tolerance", default=0.0, type="float", help="Stop EM once the relative change of the log-likelihood is below this (default=0, run all iterations)")
+optparser.add_option("--heldout", dest="heldout", default=0, type="int", help="Number of last training pairs kept out of training and scored after every EM iteration; EM stops when their perplexity stops improving (default=0, off)")
+optparser.add_option("--warm_start", dest="warm_start", default="ibm1", choices=["ibm1", "ibm2"], help="Model the HMM starts from: ibm1, or ibm2 for the diagonal IBM2 whose jump distribution also initializes the transitions (default=ibm1)")
+optparser.add_option("--online", dest="online", default=0, type="int", help="Train IBM1 with stepwise online EM on mini-batches of this many pairs; the mini-batches are cut from the corpus already loaded for the HMM, so this bounds the IBM1 counts but not the corpus in memory (default=0, batch EM)")
+optparser.add_option("--max_events", dest="max_events", default=None, type="int", help="Most word pairs kept by online IBM1, the rarest are dropped beyond it (default=no limit)")
+optparser.add_option("--bidirectional", dest="bidirectional", default=False, action="store_true", help="Train IBM1 and the HMM in both directions, IBM1 in one joint pass, and output the intersection of the two alignments")
+optparser.add_option("--jump_window", dest="jump_window", default=None, type="int", help="Pool HMM jumps longer than this into one tail bucket per side and run forward-backward and Viterbi over the band of this width only (default=off)")
 (opts, _) = optparser.parse_args()
 f_data = "%s.%s" % (opts.train, opts.french)
 e_data = "%s.%s" % (opts.train, opts.english)
 #i_data = "project/hansards.it"
 #es_data = "project/hansards.es"
+languages = [language for language in opts.languages.split(",") if language]
+#More languages are read as files next to -p/-f/-e, which a single -b file does not have
+if opts.bitext and languages:
+    optparser.error("-m/--languages cannot be used with -b/--bitext")
+#The joint pass of --bidirectional trains IBM1 only, so there is no IBM2 jump prior to start from
+if opts.bidirectional and opts.warm_start == 'ibm2':
+    optparser.error("--warm_start ibm2 cannot be used with --bidirectional")
 
 test_f_data = f_data
 
@@ -53,54 +81,116 @@ test_e_data = e_data
 
 #alignment = 'alignment'
 
-if not ( os.path.isfile(f_data) and os.path.isfile(e_data) ):
+#Training files, either an f/e file pair or one parallel file
+if opts.bitext:
+    train_data = [opts.bitext]
+    test_f_data = opts.bitext
+    test_e_data = None
+else:
+    train_data = [f_data, e_data] + ["%s.%s" % (opts.train, language) for language in languages]
+
+if not all(os.path.isfile(data) for data in train_data):
     print >>sys.stderr, __doc__.strip('\n\r')
     sys.exit(1)
 
 sys.stderr.write("Training started...")
 
-bitext_fe = [[sentence.strip().split() for sentence in pair] for pair in zip(open(f_data), open(e_data))[:opts.num_sents]]
-bitext_ef = [[sentence.strip().split() for sentence in pair] for pair in zip(open(e_data), open(f_data))[:opts.num_sents]]
-
-
-bitext_test = [[sentence.strip().split() for sentence in pair] for pair in zip(open(test_f_data), open(test_e_data))[:opts.num_sents]]
-
-f_count = defaultdict(int)
-e_count = defaultdict(int)
-
-fe_count = defaultdict(int)
-ef_count = defaultdict(int)
-
-normalizing_decision_map = defaultdict(list)
-
-feature_index = defaultdict(int)
-
-f_vector = defaultdict(int)
-
-#Useful for multiprocessing
-event_index = set([])
-
-for (n, (f, e)) in enumerate(bitext_fe):
-  for f_i in set(f):
-    f_count[f_i] += 1
-    for e_j in set(e):
-      fe_count[(f_i,e_j)] += 1
-      ef_count[(e_j,f_i)] += 1
-
-      event_index.add((f_i, e_j))
-
-      if f_i not in normalizing_decision_map[e_j]:
-          normalizing_decision_map[e_j] += [f_i]
-
-      features_list = get_features_fired(f_i,e_j)
-      for feature in features_list:
-          if feature not in feature_index:
-              feature_index[feature] = len(feature_index)
-          f_vector[feature_index[feature]] += 1
-  for e_j in e:
-    e_count[e_j] += 1
-
-event_index = sorted(list(event_index))
+#The corpus and its counts are reused from the cache when the same files and -n were seen before
+cached = None
+if opts.cache and not languages:
+    corpus_key = cache_key(train_data, opts.num_sents, (opts.max_length, opts.length_policy, opts.rare_count, opts.rare_class, opts.heldout))
+    cached = load_cache(opts.cache, corpus_key)
+
+if cached is not None:
+    (bitext_fe, counts, extras) = cached
+    feature_index = extras['feature_index']
+    f_vector = extras['f_vector']
+    length_stats = extras['length_stats']
+    (f_buckets, e_buckets) = extras['rare_word_buckets']
+else:
+    #The corpus is read and tokenized once; the reverse direction and the test set are views over it
+    if opts.bitext:
+        bitext_fe = load_parallel_file(opts.bitext, opts.num_sents)
+    elif languages:
+        #All languages are read in one pass against a single interned English side
+        multilingual = load_multilingual(e_data, [(opts.french, f_data)] + [(language, "%s.%s" % (opts.train, language)) for language in languages], opts.num_sents)
+        bitext_fe = multilingual.pair(opts.french)
+    else:
+        bitext_fe = load_bitext(f_data, e_data, opts.num_sents)
+    #Bound the sentence lengths, and with them the size of the transition tables
+    length_stats = None
+    if opts.max_length > 0:
+        (bitext_fe, _, length_stats) = apply_length_policy(bitext_fe, opts.max_length, opts.length_policy)
+    #Rare words share class tokens, which shrinks the event space of IBM1 and the HMM
+    (f_buckets, e_buckets) = (None, None)
+    if opts.rare_count > 0:
+        (bitext_fe, f_buckets, e_buckets) = bucket_rare_words(bitext_fe, opts.rare_count, opts.rare_class)
+    #Co-occurrence counts over set(f) x set(e) of every sentence, counted in parallel shards.
+    #The held-out pairs at the end of the corpus are left out.
+    counts = count_cooccurrences(bitext_fe[:len(bitext_fe) - opts.heldout], opts.processes)
+
+#The held-out pairs are only scored, training sees the rest
+bitext_all = bitext_fe
+bitext_fe = bitext_all[:len(bitext_all) - opts.heldout]
+bitext_heldout = bitext_all[len(bitext_all) - opts.heldout:] if opts.heldout > 0 else None
+
+#All bitexts share the same french and english vocabularies
+f_vocab = bitext_fe.source_vocab
+e_vocab = bitext_fe.target_vocab
+
+bitext_ef = bitext_fe.reverse()
+
+if length_stats is not None:
+    sys.stderr.write("Length policy '%s' with max length %d: %d of %d pairs over length, %d source and %d target tokens removed, %d pairs after the policy\n" % (
+        opts.length_policy, opts.max_length, length_stats['over_length'], length_stats['pairs'],
+        length_stats['source_tokens_removed'], length_stats['target_tokens_removed'], len(bitext_all)))
+
+#The test set is always aligned in full, so it is only a view when training saw the same pairs
+test_is_train = opts.bitext or (test_f_data, test_e_data) == (f_data, e_data)
+if f_buckets is not None:
+    sys.stderr.write("%d french and %d english words replaced by %s classes\n" % (f_buckets.rare_words(), e_buckets.rare_words(), opts.rare_class))
+    #The test set is read with the original words and then bucketed like the training data
+    (test_f_vocab, test_e_vocab) = (f_buckets.original_vocab, e_buckets.original_vocab)
+else:
+    (test_f_vocab, test_e_vocab) = (f_vocab, e_vocab)
+
+if test_is_train and length_stats is None:
+    bitext_test = bitext_all[:opts.num_sents]
+else:
+    if test_e_data is None:
+        bitext_test = load_parallel_file(test_f_data, opts.num_sents, test_f_vocab, test_e_vocab)
+    else:
+        bitext_test = load_bitext(test_f_data, test_e_data, opts.num_sents, test_f_vocab, test_e_vocab)
+    if f_buckets is not None:
+        bitext_test = apply_rare_word_buckets(bitext_test, f_buckets, e_buckets)
+
+f_count = counts.source_count_dict()
+e_count = counts.target_count_dict()
+
+#One co-occurrence store viewed in both directions
+fe_count = counts.view()
+ef_count = counts.view(reverse=True)
+
+normalizing_decision_map = counts.decision_map()
+
+#Useful for multiprocessing, sorted by (f, e)
+event_index = counts.events()
+
+if cached is None:
+    feature_index = defaultdict(int)
+
+    f_vector = defaultdict(int)
+
+    #A feature fires once for every sentence its event co-occurs in
+    for ((f_i, e_j), n) in fe_count.iteritems():
+        features_list = get_features_fired(f_i,e_j)
+        for feature in features_list:
+            if feature not in feature_index:
+                feature_index[feature] = len(feature_index)
+            f_vector[feature_index[feature]] += n
+
+    if opts.cache and not languages:
+        save_cache(opts.cache, corpus_key, bitext_all, counts, {'feature_index': feature_index, 'f_vector': f_vector, 'length_stats': length_stats, 'rare_word_buckets': (f_buckets, e_buckets)})
 #print 'normal ', len(normalizing_decision_map['the'])
 #print 'f vec ', f_vector[feature_index[('EMISSION','le','the')]]
 def print_alignment_SD_ibm1(bitext,t_sd, alignmentFile, num_lines):
@@ -214,34 +304,101 @@ def read_de_en_file(file_name):
     de_file.close()
     en_file.close()
 
+def schedule(name, iterations, heldout=None):
+    return EMSchedule(name, iterations, opts.tolerance, heldout)
+
 def run_IBM1():
-    t_fe = EM_IBM1(f_count,e_count,fe_count,bitext_fe)
+    if opts.online > 0:
+        #Mini-batches are streamed as words and interned again into the same vocabularies. They
+        #come from the loaded corpus, which the HMM needs anyway and which already went through
+        #-n, the length policy, the rare word classes and the held-out split; EM_IBM1_online
+        #over read_bitext is the way to train IBM1 without loading the corpus
+        training_stream = lambda: ((f_vocab.decode(S), e_vocab.decode(D)) for (S, D) in bitext_fe)
+        (t_fe, _, _) = EM_IBM1_online(training_stream, f_vocab, e_vocab, schedule('IBM1 online', opts.ibm1_iterations, bitext_heldout), opts.online, max_events=opts.max_events)
+        #Pairs dropped by --max_events get the floor of the online E step instead of t=0,
+        #which would leave the HMM without any emission for them
+        return t_table_over_events(t_fe, fe_count, 1.0/len(f_vocab))
+    t_fe = EM_IBM1_vectorized(f_count,fe_count,bitext_fe,schedule('IBM1', opts.ibm1_iterations, bitext_heldout),processes=opts.processes)
     return t_fe
 
+def run_IBM1_bidirectional():
+    (t_fe, t_ef) = EM_IBM1_bidirectional(f_count,e_count,fe_count,bitext_fe,schedule('IBM1 bidirectional', opts.ibm1_iterations, bitext_heldout),processes=opts.processes)
+    return (t_fe, t_ef)
+
+def run_IBM2():
+    (t_fe, jump_prior) = EM_IBM2_diagonal(f_count,fe_count,bitext_fe,schedule('IBM2', opts.ibm1_iterations, bitext_heldout),processes=opts.processes)
+    return (t_fe, jump_prior)
+
 def run_HMM(t_fe):
     startTime = time.time()
-    (a,b,pi) = baumWelchP(bitext_fe, f_count, t_fe,fe_count)
+    (a,b,pi) = baumWelchP(bitext_fe, f_count, t_fe,fe_count,schedule('HMM', opts.hmm_iterations, bitext_heldout))
     #(a,b,pi) = em_with_features(bitext_fe, f_count, t_fe,fe_count)
     endTime = time.time()
     print "run time for hmm model %.2gs" % (endTime - startTime)
     return (a,b,pi)
 
-def run_HMM_with_length(t_fe):
+def run_HMM_with_length(t_fe, jump_prior=None):
     startTime = time.time()
-    (a,b,pi) = baumWelchP(bitext_fe, f_count, t_fe,fe_count)
+    (a,b,pi) = baumWelchP(bitext_fe, f_count, t_fe,fe_count,schedule('HMM', opts.hmm_iterations, bitext_heldout),jump_prior,window=opts.jump_window)
     #(a,b,pi) = em_with_features(bitext_fe, f_count, t_fe,fe_count)
     endTime = time.time()
     print "run time for hmm model %.2gs" % (endTime - startTime)
     return (a,b,pi)
 
+def run_HMM_reverse(t_ef):
+    startTime = time.time()
+    heldout_ef = bitext_heldout.reverse() if bitext_heldout is not None else None
+    (a,b,pi) = baumWelchP(bitext_ef, e_count, t_ef,ef_count,schedule('HMM ef', opts.hmm_iterations, heldout_ef),window=opts.jump_window)
+    endTime = time.time()
+    print "run time for hmm model ef %.2gs" % (endTime - startTime)
+    return (a,b,pi)
+
 def run_HMM_Null(t_fe):
     startTime = time.time()
-    (a,b,pi) = baumWelchP(bitext_fe, f_count, t_fe,fe_count)
+    (a,b,pi) = baumWelchP(bitext_fe, f_count, t_fe,fe_count,schedule('HMM', opts.hmm_iterations, bitext_heldout))
     #(a,b,pi) = em_with_features(bitext_fe, f_count, t_fe,fe_count)
     endTime = time.time()
     print "run time for hmm model %.2gs" % (endTime - startTime)
     return (a,b,pi)
 
+def run_pair(language, bitext_sd):
+    #IBM1 and HMM for one more language, reusing the English side shared with the French pair,
+    #with the same options as the French pair
+    if opts.max_length > 0:
+        (bitext_sd, _, _) = apply_length_policy(bitext_sd, opts.max_length, opts.length_policy)
+    test_sd = multilingual.pair(language)
+    if opts.rare_count > 0:
+        (bitext_sd, s_buckets, d_buckets) = bucket_rare_words(bitext_sd, opts.rare_count, opts.rare_class)
+        test_sd = apply_rare_word_buckets(test_sd, s_buckets, d_buckets)
+    heldout_sd = bitext_sd[len(bitext_sd) - opts.heldout:] if opts.heldout > 0 else None
+    bitext_sd = bitext_sd[:len(bitext_sd) - opts.heldout]
+    sd_counts = count_cooccurrences(bitext_sd, opts.processes)
+    s_count = sd_counts.source_count_dict()
+    d_count = sd_counts.target_count_dict()
+    sd_count = sd_counts.view()
+    jump_prior = None
+    if opts.bidirectional:
+        (t_sd, t_ds) = EM_IBM1_bidirectional(s_count, d_count, sd_count, bitext_sd, schedule('IBM1 bidirectional %s' % language, opts.ibm1_iterations, heldout_sd), processes=opts.processes)
+    elif opts.warm_start == 'ibm2':
+        (t_sd, jump_prior) = EM_IBM2_diagonal(s_count, sd_count, bitext_sd, schedule('IBM2 %s' % language, opts.ibm1_iterations, heldout_sd), processes=opts.processes)
+    elif opts.online > 0:
+        (s_vocab, d_vocab) = (bitext_sd.source_vocab, bitext_sd.target_vocab)
+        training_stream = lambda: ((s_vocab.decode(S), d_vocab.decode(D)) for (S, D) in bitext_sd)
+        (t_sd, _, _) = EM_IBM1_online(training_stream, s_vocab, d_vocab, schedule('IBM1 online %s' % language, opts.ibm1_iterations, heldout_sd), opts.online, max_events=opts.max_events)
+        t_sd = t_table_over_events(t_sd, sd_count, 1.0/len(s_vocab))
+    else:
+        t_sd = EM_IBM1_vectorized(s_count, sd_count, bitext_sd, schedule('IBM1 %s' % language, opts.ibm1_iterations, heldout_sd), processes=opts.processes)
+    startTime = time.time()
+    (a_sd, b_sd, pi_sd) = baumWelchP(bitext_sd, s_count, t_sd, sd_count, schedule('HMM %s' % language, opts.hmm_iterations, heldout_sd), jump_prior, window=opts.jump_window)
+    endTime = time.time()
+    print "run time for hmm model of %s %.2gs" % (language, endTime - startTime)
+    if opts.bidirectional:
+        heldout_ds = heldout_sd.reverse() if heldout_sd is not None else None
+        (a_ds, b_ds, pi_ds) = baumWelchP(bitext_sd.reverse(), d_count, t_ds, sd_counts.view(reverse=True), schedule('HMM %s reverse' % language, opts.hmm_iterations, heldout_ds), window=opts.jump_window)
+        findBestAlignmentsForAllWithIntersection_AER(test_sd, a_sd, b_sd, pi_sd, a_ds, b_ds, pi_ds, 100, "%s.%s" % (alignment, language), opts.jump_window)
+    else:
+        findBestAlignmentsForAll_AER(test_sd, a_sd, b_sd, pi_sd, 100, "%s.%s" % (alignment, language), opts.jump_window)
+
 def run_featurized_HMM():
     print 'kappa',kappa
     startTime = time.time()
@@ -291,8 +448,16 @@ output = sys.stdout
 
 #print_alignment_SD_ibm1(bitext_test,t_fe, alignment, 100)
 kappa = 0.0
-t_fe = run_IBM1()
-(a, b, pi) = run_HMM_with_length(t_fe)
+jump_prior = None
+if opts.bidirectional:
+    (t_fe, t_ef) = run_IBM1_bidirectional()
+elif opts.warm_start == 'ibm2':
+    (t_fe, jump_prior) = run_IBM2()
+else:
+    t_fe = run_IBM1()
+(a, b, pi) = run_HMM_with_length(t_fe, jump_prior)
+if opts.bidirectional:
+    (a_ef, b_ef, pi_ef) = run_HMM_reverse(t_ef)
 #(a, b, pi) = run_HMM_Null(t_fe)
 #(a, b, pi) = run_featurized_HMM()
 
@@ -300,10 +465,16 @@ t_fe = run_IBM1()
 #findBestAlignmentsForAllWithIntersection_DS(bitext_fe,a,b,pi,a_ef,b_ef,pi_ef)
 #findBestAlignmentsForAll(bitext_ef,a_ef,b_ef,pi_ef)
 #findBestAlignmentsForAllWithIntersection(bitext_test, a, b, pi, a_ef, b_ef, pi_ef)
-findBestAlignmentsForAll_AER(bitext_test,a,b,pi,100, alignment)
+if opts.bidirectional:
+    findBestAlignmentsForAllWithIntersection_AER(bitext_test, a, b, pi, a_ef, b_ef, pi_ef,100,alignment,opts.jump_window)
+else:
+    findBestAlignmentsForAll_AER(bitext_test,a,b,pi,100, alignment,opts.jump_window)
 #findBestAlignmentsForAllWithIntersection_AER(bitext_test, a, b, pi, a_ef, b_ef, pi_ef,448,alignment)
 
-grade_align(f_data, e_data, gold, alignment,output)
+grade_align(test_f_data, test_e_data, gold, alignment,output)
+
+for language in languages:
+    run_pair(language, multilingual.pair(language))
 
 #findBestAlignmentsForAll_AER(bitext_test,a,b,pi,100, alignment)
 #grade_align(f_data, e_data, gold, "alignment_5000_BT_100_mist_HMM",output)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'amansour'
+
+import numpy as np
+from itertools import izip
+
+from corpus import TOKEN_DTYPE, OFFSET_DTYPE
+
+
+class SparseTTable(object):
+    # Translation probabilities t(s|d) grouped by target word d: the sources seen with d are
+    # sources[indptr[d]:indptr[d+1]], sorted, with their probabilities in probs at the same
+    # positions. That is 12 bytes per entry instead of a dict entry, a tuple and two keys.
+    # Besides the batched lookup() it reads like the defaultdict(int) tables it replaces:
+    # t[(s, d)], (s, d) in t, iteration over (s, d) keys; missing pairs are 0.
+    def __init__(self, indptr, sources, probs):
+        self.indptr = indptr
+        self.sources = sources
+        self.probs = probs
+
+    def num_targets(self):
+        return len(self.indptr) - 1
+
+    def targets(self):
+        return np.repeat(np.arange(self.num_targets(), dtype=TOKEN_DTYPE), np.diff(self.indptr))
+
+    def positions(self, sources, targets):
+        # Position of every (source, target) pair in sources/probs, -1 where the pair is missing
+        sources = np.asarray(sources)
+        targets = np.asarray(targets)
+        if len(self.sources) == 0:
+            return np.full(np.broadcast(sources, targets).shape, -1, dtype=np.int64)
+        last = len(self.sources) - 1
+        known = (targets >= 0) & (targets < self.num_targets())
+        safe_targets = np.where(known, targets, 0)
+        lo = np.where(known, self.indptr[safe_targets], 0)
+        end = np.where(known, self.indptr[safe_targets + 1], 0)
+        hi = end.copy()
+        # Bisection on all queries at once, each one inside its own target's run of sources
+        searching = lo < hi
+        while searching.any():
+            mid = (lo + hi) // 2
+            right = searching & (self.sources[np.minimum(mid, last)] < sources)
+            lo = np.where(right, mid + 1, lo)
+            hi = np.where(searching & ~right, mid, hi)
+            searching = lo < hi
+        found = (lo < end) & (self.sources[np.minimum(lo, last)] == sources)
+        return np.where(found, lo, -1)
+
+    def lookup(self, sources, targets):
+        position = self.positions(sources, targets)
+        return np.where(position >= 0, self.probs[position], 0.0)
+
+    def position(self, pair):
+        # Scalar version of positions() for single dictionary-style accesses
+        (s, d) = pair
+        if not isinstance(d, (int, long, np.integer)) or not 0 <= d < self.num_targets():
+            return -1
+        (start, end) = (self.indptr[d], self.indptr[d+1])
+        k = start + np.searchsorted(self.sources[start:end], s)
+        if k < end and self.sources[k] == s:
+            return k
+        return -1
+
+    def __getitem__(self, pair):
+        k = self.position(pair)
+        return self.probs[k] if k >= 0 else 0
+
+    def get(self, pair, default=None):
+        k = self.position(pair)
+        return self.probs[k] if k >= 0 else default
+
+    def __contains__(self, pair):
+        return self.position(pair) >= 0
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __iter__(self):
+        return izip(self.sources.tolist(), self.targets().tolist())
+
+    def keys(self):
+        return list(iter(self))
+
+    def iteritems(self):
+        return izip(iter(self), self.probs.tolist())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+def t_table_from_events(event_sources, event_targets, probs, num_targets):
+    # Builds the table from parallel arrays, e.g. the event ids of a PairCountView
+    order = np.lexsort((event_sources, event_targets))
+    indptr = np.zeros(num_targets + 1, dtype=OFFSET_DTYPE)
+    np.cumsum(np.bincount(event_targets, minlength=num_targets), out=indptr[1:])
+    return SparseTTable(indptr, np.asarray(event_sources, dtype=TOKEN_DTYPE)[order], np.asarray(probs, dtype=np.float64)[order])
+